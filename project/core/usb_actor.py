@@ -0,0 +1,123 @@
+import __init__
+import queue
+import threading
+import time
+import usb.core as usbcore
+from collections import deque
+from concurrent.futures import Future
+from typing import Container, Deque, List, Tuple, Union
+
+from core.usb_util import MsgAction, MsgSender, ProtocolType, UnpackedMsg
+
+# how long a single read of the reader thread may block, it only checks if it should stop in between (in ms)
+ACTOR_READ_TIMEOUT = 100
+
+# how many answers nobody waited for are kept, in case their request is about to wait for them
+MAX_UNCLAIMED = 64
+
+
+class DeviceActor:
+	"""
+	Owns all transfers of a single device: a reader thread continuously drains the IN endpoint into the frame decoder
+	and hands every answer to the request waiting for it, a writer thread sends the queued messages in order.
+	"""
+
+	def __init__(self, device, protocol: ProtocolType, readSize: int):
+		self.device = device
+		self.protocol = protocol
+		self.readSize = readSize
+		self.lock = threading.Lock()
+		# requests waiting for an answer, in the order they started to wait
+		self.waiters: List[Tuple[MsgAction, Container[int], Future]] = []
+		self.unclaimed: Deque[UnpackedMsg] = deque(maxlen=MAX_UNCLAIMED)
+		self.writeQueue: "queue.Queue[Union[None, Tuple[bytes, Future]]]" = queue.Queue()
+		self.running = True
+		self.reader = threading.Thread(target=self.readLoop, name="USB_Reader_%s" % device.id, daemon=True)
+		self.writer = threading.Thread(target=self.writeLoop, name="USB_Writer_%s" % device.id, daemon=True)
+		self.reader.start()
+		self.writer.start()
+
+	def write(self, pack: Union[str, bytes]) -> Future:
+		future = Future()
+		self.writeQueue.put((pack, future))
+		return future
+
+	def expect(self, wantedAction: MsgAction = None, wantedIds: Container[int] = None) -> Future:
+		"""Returns a future for the next answer that fits, answers that already arrived are checked first."""
+		future = Future()
+		with self.lock:
+			for answer in self.unclaimed:
+				if self.isWanted(answer, wantedAction, wantedIds):
+					self.unclaimed.remove(answer)
+					future.set_result(answer)
+					return future
+			self.waiters.append((wantedAction, wantedIds, future))
+		return future
+
+	def cancel(self, future: Future):
+		with self.lock:
+			self.waiters = [waiter for waiter in self.waiters if waiter[2] is not future]
+		future.cancel()
+
+	def clear(self):
+		with self.lock:
+			self.unclaimed.clear()
+
+	def isWanted(self, answer: UnpackedMsg, wantedAction: MsgAction, wantedIds: Container[int]) -> bool:
+		if wantedAction and answer.action != wantedAction.value:
+			return False
+		return wantedIds is None or answer.requestId in wantedIds
+
+	def dispatch(self, answer: UnpackedMsg):
+		self.device.grantCredits(answer.credits)
+		# echoed commands are never waited for
+		if answer.sender == MsgSender.HOST.value:
+			return
+		with self.lock:
+			for i, (wantedAction, wantedIds, future) in enumerate(self.waiters):
+				if self.isWanted(answer, wantedAction, wantedIds):
+					del self.waiters[i]
+					future.set_result(answer)
+					return
+			# late answers of timed out requests end up here and are pushed out by newer ones
+			self.unclaimed.append(answer)
+
+	def readLoop(self):
+		decoder = self.device.getDecoder(self.protocol)
+		while self.running:
+			try:
+				data = self.device.transport.receive(self.readSize, ACTOR_READ_TIMEOUT)
+			except usbcore.USBTimeoutError:
+				continue
+			except Exception as e:
+				if not self.running:
+					break
+				print("Read Error:", e)
+				time.sleep(ACTOR_READ_TIMEOUT / 1000)
+				continue
+			if not data:
+				# the other end is gone, don't spin until the host closes the device
+				time.sleep(ACTOR_READ_TIMEOUT / 1000)
+				continue
+			decoder.feed(data)
+			for frame in decoder.frames():
+				self.dispatch(decoder.unpack(frame))
+
+	def writeLoop(self):
+		while (item := self.writeQueue.get()) is not None:
+			pack, future = item
+			try:
+				future.set_result(self.device.transport.write(pack))
+			except Exception as e:
+				print("Send Error:", e)
+				future.set_exception(e)
+
+	def stop(self):
+		"""Lets both threads finish without waiting for them, the reader notices it with its next read."""
+		self.running = False
+		self.writeQueue.put(None)
+
+	def close(self):
+		self.stop()
+		self.writer.join()
+		self.reader.join()
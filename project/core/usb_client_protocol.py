@@ -0,0 +1,242 @@
+import __init__
+import os
+import io
+import tty
+from typing import Dict, Iterator, List, Union
+
+from core.usb_util import MsgAction, MsgOperation, MsgStatus, MsgSender, packMsg, unpackMsg, UnpackedMsg
+from core.usb_util import ProtocolType, PROTOCOL_TYPE, USE_TTY_ECHO, packBinaryMsg, unpackBatch, toBytes, FrameDecoder, STREAM_CHUNK_SIZE, RECEIVE_WINDOW, CREDIT_MASK
+from core.usb_util import Capabilities, Feature, packCapabilities, WRITE_SIZE, MAX_FRAME_SIZE, MAX_BATCH_SIZE
+
+
+def chunks(arr: List, n):
+	n = max(1, n)
+	return list(arr[i: i + n] for i in range(0, len(arr), n))
+
+
+class USB_Client_Protocol:
+	"""
+	Answers the host's requests on a single device, shared by the thread and the process clients.
+	start() has to serve the device until the host sends STOP.
+	"""
+
+	def __init__(self, id: int, protocol: ProtocolType = PROTOCOL_TYPE, echo: bool = USE_TTY_ECHO, deviceFile: Union[str, int] = None):
+		super().__init__()
+		self.id = id
+		self.active = False
+		# a tty path or an already open file descriptor (e.g. one end of a socketpair)
+		self.deviceFile = deviceFile if deviceFile is not None else "/dev/ttyGS%s" % (self.id)
+		self.protocol = protocol
+		self.echo = echo and protocol == ProtocolType.TEXT
+		# bytes of all handled binary frames, used to grant the host new credits
+		self.processedBytes = 0
+
+	def activate(self):
+		if self.active:
+			print("Already active!")
+			return
+		self.active = True
+		self.start()
+
+	def run(self):
+		if self.protocol == ProtocolType.BINARY:
+			self.runBinary()
+			return
+		try:
+			fd = self.openDevice(os.O_RDWR)
+			if not self.echo and os.isatty(fd):
+				# without echo and line editing every frame ends with its "\r"
+				tty.setraw(fd)
+			f = io.TextIOWrapper(io.FileIO(fd, "r+"), newline=None if self.echo else "\r")
+			for msg in iter(f.readline, ""):
+				unpackedMsg = unpackMsg(msg)
+				if not unpackedMsg:
+					continue
+
+				response = self.respond(unpackedMsg)
+				responseMsg = packMsg(MsgSender.CLIENT, response["status"], response["action"], response["operation"], response["data"])
+
+				for rMsg in chunks(responseMsg, WRITE_SIZE):
+					f.write(rMsg)
+
+				# stop listening if stop command was send
+				if (response["action"] == MsgAction.STOP.value):
+					return
+
+		except Exception as e:
+			print("Receive Error:", e)
+		finally:
+			if "f" in locals():
+				f.close()
+
+	def runBinary(self):
+		try:
+			fd = self.openDevice(os.O_RDWR | os.O_NOCTTY)
+			# binary frames must not be altered (or echoed) by the line discipline
+			if os.isatty(fd):
+				tty.setraw(fd)
+			decoder = FrameDecoder(ProtocolType.BINARY)
+			while (chunk := os.read(fd, 4096)):
+				decoder.feed(chunk)
+				for frame in decoder.frames():
+					content = decoder.unpack(frame)
+					self.processedBytes += len(frame)
+					if content.stream and content.action == MsgAction.CALCULATE.value:
+						self.streamResponse(fd, content)
+						continue
+
+					response = self.respond(content)
+					responseMsg = packBinaryMsg(
+						MsgSender.CLIENT,
+						response["status"],
+						response["action"],
+						response["operation"],
+						response["data"],
+						response["requestId"],
+						response["compression"],
+						credits=self.getCreditLimit()
+					)
+
+					self.writeFrame(fd, responseMsg)
+
+					# stop listening if stop command was send
+					if (response["action"] == MsgAction.STOP.value):
+						return
+
+		except Exception as e:
+			print("Receive Error:", e)
+		finally:
+			if "fd" in locals():
+				os.close(fd)
+
+	def openDevice(self, flags: int) -> int:
+		if isinstance(self.deviceFile, int):
+			# the transport keeps its own end open
+			return os.dup(self.deviceFile)
+		return os.open(self.deviceFile, flags)
+
+	def getCreditLimit(self) -> int:
+		# the host may send until its total sent bytes reach this limit
+		return (self.processedBytes + RECEIVE_WINDOW) & CREDIT_MASK
+
+	def writeFrame(self, fd: int, frame: bytes):
+		for rMsg in chunks(memoryview(frame), WRITE_SIZE):
+			while rMsg:
+				rMsg = rMsg[os.write(fd, rMsg):]
+
+	def streamResponse(self, fd: int, content: UnpackedMsg):
+		# every chunk is send as soon as it is ready, the last frame has no payload and the final status
+		sequence = 0
+		status = MsgStatus.OK
+		try:
+			for chunk in self.handleInputStream(content):
+				self.writeFrame(fd, packBinaryMsg(
+					MsgSender.CLIENT,
+					MsgStatus.ONGOING,
+					content.action,
+					content.operation,
+					chunk,
+					content.requestId,
+					content.compression,
+					sequence,
+					credits=self.getCreditLimit()
+				))
+				sequence += 1
+		except Exception as e:
+			status = MsgStatus.FAIL
+			print(e)
+		self.writeFrame(fd, packBinaryMsg(
+			MsgSender.CLIENT, status, content.action, content.operation, b"", content.requestId, content.compression, sequence, credits=self.getCreditLimit()
+		))
+
+	def handleInputStream(self, content: UnpackedMsg) -> Iterator[bytes]:
+		if content.operation == MsgOperation.TESTLOAD.value:
+			remaining = int(content.data.strip())
+			chunk = b"a" * min(remaining, STREAM_CHUNK_SIZE)
+			while remaining > 0:
+				yield chunk[:remaining]
+				remaining -= len(chunk)
+		else:
+			status, data = self.handleInput(content)
+			if status != MsgStatus.OK:
+				raise Exception("Operation %s failed" % content.operation)
+			yield toBytes(data)
+
+	def respond(self, content: UnpackedMsg) -> Dict:
+		# print("Receive message: ", content)
+		response = {
+			"status": MsgStatus.UNKNOWN,
+			"action": int(content.action),
+			"operation": int(content.operation),
+			"data": "",
+			"requestId": content.requestId,
+			# answer with the codec the host accepts
+			"compression": content.compression
+		}
+		action = int(content.action)
+
+		if content.status == MsgStatus.CORRUPT.value:
+			response["status"] = MsgStatus.FAIL
+		elif action == MsgAction.STOP.value:
+			if self.active:
+				self.active = False
+				response["status"] = MsgStatus.OK
+			else:
+				response["status"] = MsgStatus.FAIL
+		elif action == MsgAction.PING.value:
+			response["status"] = MsgStatus.OK
+		elif action == MsgAction.HELLO.value:
+			response["status"] = MsgStatus.OK
+			response["data"] = packCapabilities(self.getCapabilities())
+		elif action == MsgAction.CALCULATE.value:
+			response["status"], response["data"] = self.handleInput(content)
+		elif action == MsgAction.BATCH.value:
+			response["status"], response["data"] = self.handleBatch(content)
+
+		else:
+			pass
+			# print("Cannot respond to: ", action)
+		return response
+
+	def getCapabilities(self) -> Capabilities:
+		operations = (1 << MsgOperation.MULTIPLY.value) | (1 << MsgOperation.TESTLOAD.value)
+		if self.protocol != ProtocolType.BINARY:
+			return Capabilities(MAX_FRAME_SIZE, WRITE_SIZE, RECEIVE_WINDOW, 1, STREAM_CHUNK_SIZE, operations, 0)
+		features = Feature.BATCH.value | Feature.STREAM.value | Feature.ZLIB.value | Feature.LZMA.value | Feature.CHECKSUM.value
+		return Capabilities(MAX_FRAME_SIZE, WRITE_SIZE, RECEIVE_WINDOW, MAX_BATCH_SIZE, STREAM_CHUNK_SIZE, operations, features)
+
+	def handleBatch(self, content: UnpackedMsg) -> Dict:
+		# every request of the batch is answered, all answers are send back in a single frame
+		try:
+			answers = []
+			for request in unpackBatch(content.data):
+				response = self.respond(request)
+				answers.append(packBinaryMsg(
+					MsgSender.CLIENT, response["status"], response["action"], response["operation"], response["data"], response["requestId"]
+				))
+			return MsgStatus.OK, b"".join(answers)
+		except Exception as e:
+			print(e)
+			return MsgStatus.FAIL, b""
+
+	def handleInput(self, content: UnpackedMsg) -> Dict:
+		status = MsgStatus.OK
+		data = ""
+		try:
+			if content.operation == MsgOperation.MULTIPLY.value:
+				input = int(content.data)
+				data = input * 2
+			elif content.operation == MsgOperation.AVERAGE.value:
+				# totalSum = sum(input)
+				# data = totalSum / len(input)
+				raise Exception
+			elif content.operation == MsgOperation.FINDX.value:
+				# data = input[1][input[0]]
+				raise Exception
+			elif content.operation == MsgOperation.TESTLOAD.value:
+				dataLen = int(content.data.strip())
+				data = b"a" * dataLen if isinstance(content.data, bytes) else "a" * dataLen
+		except Exception as e:
+			status = MsgStatus.FAIL
+			print(e)
+		return status, data
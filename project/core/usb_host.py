@@ -1,40 +1,277 @@
-from multiprocessing.connection import Connection
-import sys
 import os
 import usb.core as core
-from typing import Dict, List, Union, Tuple
-import threading
-from multiprocessing import Pipe, Process
-from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Container, Dict, Iterator, List, Union, Tuple
+from multiprocessing import Process, Value, get_context
+from timeit import default_timer as timer
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import asyncio
+import random
+import time
 import traceback
-import psutil
 
-from core.usb_util import GetDevice, MsgAction, MsgOperation, MsgStatus, MsgSender, packMsg, unpackMsg, GetAllDevices, UnpackedMsg, byteArrToString
-from core.usb_util import CONFIGURATION_ID, SETTING_ID, OUT_ENDPOINT_ID, IN_ENDPOINT_ID
+from core.usb_util import MsgAction, MsgOperation, MsgStatus, MsgSender, packMsg, UnpackedMsg
+from core.usb_util import DEVICE_REGISTRY, DeviceKey, RefreshDevices, openEndpoints
+from core.usb_util import ProtocolType, PROTOCOL_TYPE, Compression, COMPRESSION, USE_TTY_ECHO, BINARY_HEADER, TEXT_MIN_FRAME_SIZE, MAX_REQUEST_ID, packBinaryMsg, unpackBatch, stripPayload, FrameDecoder, STREAM_CHUNK_SIZE
+from core.usb_util import RECEIVE_WINDOW, CREDIT_MASK, Capabilities, Feature, unpackCapabilities, getEnumValue
+from core.usb_util import TransportType, TRANSPORT_TYPE, DeviceSelection, MAX_FRAME_SIZE
+from core.usb_libusb import LIBUSB_AVAILABLE, OpenEndpoints
+from core.usb_transport import Transport, USB_Transport, MakeTransport
+from core.usb_actor import DeviceActor
+from core.usb_shared import SharedRing, putJob, getJob, putResults, getResults, putTimes, getTimes, putCounts, getCounts
 from core.resource_manager import SetHostCores
 from util import suppress_stdout
 
-# Should a threads be used to simulate asynchroneous behavior for asyncio?
-USE_ASYNC_THREADPOOL = True
+# Should a threads be used to simulate asynchroneous behavior for asyncio? Otherwise the transports are awaited directly
+USE_ASYNC_THREADPOOL = False
+
+# Should libusb-1.0 be used directly for the bulk transfers instead of pyusb? (falls back to pyusb if it can't be loaded)
+USE_LIBUSB = False
+
+# How often are the gadgets enumerated again, to pick up plugged in and removed ones? (in seconds, only between requests)
+DEVICE_REFRESH_INTERVAL = 5.0
+
+# How many worker processes does the hybrid host start at most? (each drives several devices)
+PROCESS_COUNT = 6
+
+# How are loads spread over the devices? (see DeviceSelection, POWER_OF_TWO often leaves idle devices out of small rounds)
+DEVICE_SELECTION = DeviceSelection.LEAST_OUTSTANDING
+
+# How fast do the round trip time and error rate estimates of a device follow new requests? (weight of the newest request)
+RTT_ALPHA = 0.125
+ERROR_ALPHA = 0.05
+
+# How many processes calculate for the host? (at most one per core the host may run on)
+COMPUTE_PROCESS_COUNT = len(os.sched_getaffinity(0))
+
+# Is the host side calculation of test loads handed to a process pool, so the devices can go on with their next loads?
+# (only worth it if there is a core to spare)
+USE_COMPUTE_POOL = COMPUTE_PROCESS_COUNT > 1
+
+# How long may a broadcast (e.g. ping or deactivate) wait for the answers of all devices at most? (in ms)
+BROADCAST_TIMEOUT = 1000
+
+# Bounds of the adaptive read timeouts, requests without any measurement of their size wait INITIAL_TIMEOUT (in ms)
+INITIAL_TIMEOUT = 1000
+MIN_TIMEOUT = 50
+MAX_TIMEOUT = 8000
+
+# How fast does the deviation estimate follow new round trips and how much of it is added to a timeout? (as in TCP)
+RTT_DEVIATION_BETA = 0.25
+RTT_DEVIATION_FACTOR = 4
+
+# Requests up to this many bytes share one round trip estimate, above it every doubling gets its own
+TIMEOUT_BUCKET_SIZE = 256
+
+# How often are failed loads sent again and how long is waited before? (exponential backoff with full jitter, in s)
+RETRY_COUNT = 2
+RETRY_BASE_DELAY = 0.01
+RETRY_MAX_DELAY = 0.5
+
+# After how many failed requests in a row is a device taken out of rotation?
+CIRCUIT_FAILURES = 8
+
+# How long does a device stay out of rotation before it is pinged again? (in s)
+CIRCUIT_PROBE_INTERVAL = 1.0
+
+# How many requests may be unanswered per device at the same time? (only used by the binary protocol)
+MAX_IN_FLIGHT = 4
+
+# How many CALCULATE requests are packed into a single BATCH frame? (only used by the binary protocol)
+BATCH_SIZE = 1
+
+
+class LoadQueue:
+	"""Hands out the loads of a request to whichever device asks first, shared by threads and worker processes alike."""
+
+	def __init__(self):
+		self.remaining = Value("q", 0)
+
+	def reset(self, loadCount: int):
+		with self.remaining.get_lock():
+			self.remaining.value = loadCount
+
+	def take(self, maxCount: int) -> int:
+		with self.remaining.get_lock():
+			count = min(maxCount, self.remaining.value)
+			self.remaining.value -= count
+		return count
+
+
+class RttEstimator:
+	"""
+	Jacobson/Karels estimate of the round trip time and its mean deviation, the timeout is their weighted sum.
+	Every timeout doubles the next one until an answer arrives again.
+	"""
+
+	def __init__(self):
+		self.srtt: float = None
+		self.rttvar = 0.0
+		self.backoff = 1
+		self.backoffAt: float = None
+
+	def update(self, rtt: float):
+		if self.srtt is None:
+			self.srtt = rtt
+			self.rttvar = rtt / 2
+		else:
+			self.rttvar += RTT_DEVIATION_BETA * (abs(self.srtt - rtt) - self.rttvar)
+			self.srtt += RTT_ALPHA * (rtt - self.srtt)
+		self.backoff = 1
+
+	def timedOut(self, start: float = None):
+		# requests that were already waiting when the timeout last doubled ran into the same outage
+		if start is not None and self.backoffAt is not None and start <= self.backoffAt:
+			return
+		self.backoff = min(self.backoff * 2, MAX_TIMEOUT // MIN_TIMEOUT)
+		self.backoffAt = timer()
+
+	def getTimeout(self) -> int:
+		"""Returns the timeout in ms."""
+		timeout = INITIAL_TIMEOUT if self.srtt is None else (self.srtt + RTT_DEVIATION_FACTOR * self.rttvar) * 1000
+		return int(min(max(timeout, MIN_TIMEOUT) * self.backoff, MAX_TIMEOUT))
+
+
+class RetryPolicy:
+	"""How often failed requests are sent again, every retry waits a random time up to an exponentially growing limit."""
+
+	def __init__(self, retries: int = RETRY_COUNT, baseDelay: float = RETRY_BASE_DELAY, maxDelay: float = RETRY_MAX_DELAY):
+		self.retries = retries
+		self.baseDelay = baseDelay
+		self.maxDelay = maxDelay
+
+	def getDelay(self, attempt: int) -> float:
+		# the jitter keeps devices that failed together from retrying together
+		return random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+
+
+class CircuitBreaker:
+	"""Opens after CIRCUIT_FAILURES failed requests in a row, the device then only gets a ping every CIRCUIT_PROBE_INTERVAL."""
+
+	def __init__(self):
+		self.failures = 0
+		self.openedAt: float = None
+
+	def recordSuccess(self):
+		self.failures = 0
+		self.openedAt = None
+
+	def recordFailure(self):
+		self.failures += 1
+		if self.failures >= CIRCUIT_FAILURES:
+			# a failed probe opens it again
+			self.openedAt = timer()
+
+	def isOpen(self) -> bool:
+		return self.openedAt is not None
+
+	def isProbeDue(self) -> bool:
+		return self.isOpen() and timer() - self.openedAt >= CIRCUIT_PROBE_INTERVAL
 
 
 class USB_Device:
 
-	def __init__(self, id: int, device: core.Device):
+	def __init__(self, id: int, device: core.Device = None, key: DeviceKey = None, transport: Transport = None, useLibusb: bool = USE_LIBUSB):
 		self.id = id
 		self.device = device
+		self.key = key
+		if not transport:
+			# the registry caches the endpoints, so they are only resolved once per gadget
+			outEp, inEp = DEVICE_REGISTRY.getEndpoints(key) if key else openEndpoints(device)
+			if useLibusb and LIBUSB_AVAILABLE and key:
+				outEp, inEp = OpenEndpoints(key.bus, key.address, outEp, inEp)
+			transport = USB_Transport(id, device, outEp, inEp)
+		self.transport = transport
+		self.decoder: FrameDecoder = None
+		self.requestId = 0
+		# flow control: total bytes send to the client and the limit the client granted (binary protocol only)
+		self.sentBytes = 0
+		self.creditLimit = RECEIVE_WINDOW
+		# what the client supports, asked for with HELLO before the first request
+		self.capabilities: Capabilities = None
+		self.handshakeDone = False
+		# live statistics used to pick the least busy device
+		self.outstanding = 0
+		self.rtt: float = None
+		self.errorRate = 0.0
+		# round trip estimates per size bucket, they decide how long a read waits
+		self.rttEstimators: Dict[int, RttEstimator] = {}
+		self.timeouts = 0
+		self.breaker = CircuitBreaker()
+
+	def getDecoder(self, protocol: ProtocolType) -> FrameDecoder:
+		if not self.decoder or self.decoder.protocol != protocol:
+			# test loads are only compared by their checksum, verified payloads are not even copied out of the decoder
+			self.decoder = FrameDecoder(protocol, (MsgOperation.TESTLOAD.value,))
+		return self.decoder
+
+	def supports(self, operation: MsgOperation) -> bool:
+		return not self.capabilities or bool(self.capabilities.operations & (1 << getEnumValue(operation)))
+
+	def hasFeature(self, feature: Feature) -> bool:
+		return not self.capabilities or bool(self.capabilities.features & feature.value)
+
+	def getReadSize(self, size: int) -> int:
+		# read at least one of the pieces the client writes
+		return max(size, self.capabilities.writeSize) if self.capabilities else size
+
+	def startRequest(self) -> float:
+		self.outstanding += 1
+		return timer()
+
+	def finishRequest(self, start: float, success: bool, size: int = 0) -> float:
+		"""Updates the statistics with the finished request and returns how long it took."""
+		rtt = timer() - start
+		self.outstanding -= 1
+		if success:
+			self.rtt = rtt if self.rtt is None else self.rtt + RTT_ALPHA * (rtt - self.rtt)
+			self.getRttEstimator(size).update(rtt)
+			self.breaker.recordSuccess()
+		else:
+			self.getRttEstimator(size).timedOut(start)
+			self.breaker.recordFailure()
+		self.errorRate += ERROR_ALPHA * ((0.0 if success else 1.0) - self.errorRate)
+		return rtt
+
+	def getRttEstimator(self, size: int) -> RttEstimator:
+		bucket = (size // TIMEOUT_BUCKET_SIZE).bit_length()
+		if bucket not in self.rttEstimators:
+			self.rttEstimators[bucket] = RttEstimator()
+		return self.rttEstimators[bucket]
+
+	def getTimeout(self, size: int = 0) -> int:
+		"""Returns how long to wait for the answer to a request that transfers size bytes in total (in ms)."""
+		return self.getRttEstimator(size).getTimeout()
+
+	def getExpectedDelay(self, extraLoads: int, defaultRtt: float) -> float:
+		# time until extraLoads more requests would be answered, failed requests have to be repeated
+		rtt = self.rtt if self.rtt is not None else defaultRtt
+		return (self.outstanding + extraLoads + 1) * rtt / max(1.0 - self.errorRate, 0.1)
+
+	def setCapabilities(self, answer: UnpackedMsg) -> bool:
+		if not answer or answer.status != MsgStatus.OK.value:
+			return False
+		self.capabilities = unpackCapabilities(answer.data)
+		# the client's own window replaces the assumed one, unless the answer already granted credits
+		if not answer.credits:
+			self.creditLimit = self.capabilities.receiveWindow
+		return True
 
-		if device.is_kernel_driver_active(0):
-			try:
-				device.detach_kernel_driver(0)
-			except core.USBError as e:
-				sys.exit("Kernel driver could not be detached: %s" % str(e))
+	def getCredits(self) -> int:
+		credits = (self.creditLimit - self.sentBytes) & CREDIT_MASK
+		# a negative difference wraps around
+		return credits if credits <= CREDIT_MASK // 2 else credits - CREDIT_MASK - 1
+
+	def consumeCredits(self, size: int):
+		self.sentBytes = (self.sentBytes + size) & CREDIT_MASK
+
+	def grantCredits(self, creditLimit: int):
+		if creditLimit:
+			self.creditLimit = creditLimit
 
-		cfg = device.get_active_configuration()
-		interface = cfg[(CONFIGURATION_ID, SETTING_ID)]
-		self.outEp = interface[OUT_ENDPOINT_ID]
-		self.inEp = interface[IN_ENDPOINT_ID]
+	def nextRequestId(self) -> int:
+		# 0 is reserved for messages without a request id
+		self.requestId = self.requestId % MAX_REQUEST_ID + 1
+		return self.requestId
 
 
 def calculate(count):
@@ -43,11 +280,49 @@ def calculate(count):
 		num += 1
 
 
+def calculateLoads(count: int, loadCount: int) -> List[float]:
+	"""Does the host side calculation of loadCount loads and returns the time each one took."""
+	times = []
+	for _ in range(loadCount):
+		start = timer()
+		calculate(count)
+		times.append(timer() - start)
+	return times
+
+
 class USB_Host:
 
-	def __init__(self, count):
+	def __init__(
+		self,
+		count,
+		protocol: ProtocolType = PROTOCOL_TYPE,
+		maxInFlight: int = MAX_IN_FLIGHT,
+		batchSize: int = BATCH_SIZE,
+		compression: Compression = COMPRESSION,
+		echo: bool = USE_TTY_ECHO,
+		transportType: TransportType = TRANSPORT_TYPE,
+		deviceSelection: DeviceSelection = DEVICE_SELECTION,
+		retryPolicy: RetryPolicy = None):
+
 		self.devices = None
 		self.count = count
+		self.refreshedAt: float = None
+		self.protocol = protocol
+		self.transportType = transportType
+		self.deviceSelection = deviceSelection
+		self.retryPolicy = retryPolicy or RetryPolicy()
+		self.useComputePool = USE_COMPUTE_POOL
+		self.useLibusb = USE_LIBUSB
+		self.computePool: ProcessPoolExecutor = None
+		self.computeFutures: List[Future] = []
+		self.computeTimes: List[float] = []
+		self.maxInFlight = maxInFlight if protocol == ProtocolType.BINARY else 1
+		self.batchSize = batchSize if protocol == ProtocolType.BINARY else 1
+		self.compression = compression if protocol == ProtocolType.BINARY else Compression.NONE
+		# created up front, so worker processes inherit it
+		self.loadQueue = LoadQueue()
+		# binary clients always use a raw tty and sockets have no tty at all
+		self.echo = echo and protocol == ProtocolType.TEXT and transportType != TransportType.SOCKET
 
 	def prepareDevices(self):
 		self.getDevices(-1)
@@ -55,59 +330,196 @@ class USB_Host:
 	def getCount(self) -> int:
 		return self.count
 
+	def getQueueChunk(self) -> int:
+		# a device takes as many loads as it can have unanswered at once
+		return self.maxInFlight * self.batchSize
+
 	def ping(self, id: int = -1) -> bool:
 		answers = self.sendMessage(MsgAction.PING, MsgOperation.NONE, "", id)
 		if not isinstance(answers, list):
-			return answers.status == MsgStatus.OK.value
+			return answers is not None and answers.status == MsgStatus.OK.value
 		for answer in answers:
-			if answer.status != MsgStatus.OK.value:
+			if answer is None or answer.status != MsgStatus.OK.value:
 				return False
 		return True
 
 	def deactivate(self, id: int = -1) -> Union[MsgStatus, List[MsgStatus]]:
 		return self.sendMessage(MsgAction.STOP, MsgOperation.NONE, "", id)
 
-	def readMessage(self, dev: USB_Device, skipAll: bool = False, wantedAction: MsgAction = None, echoSize: int = 8, minSize: int = 0) -> UnpackedMsg:
+	def hello(self, id: int = -1) -> bool:
+		success = True
+		for dev in self.getDevices(id):
+			success = self.handshake(dev) and success
+		return success
+
+	def handshake(self, device: USB_Device) -> bool:
+		"""Asks the client for its capabilities, which are cached for all further requests."""
+		device.handshakeDone = True
 		try:
-			lastMsg = ""
-			waitForEcho = True
-			bufferSize = echoSize + 8 if waitForEcho else minSize + 8
-			while (result := dev.inEp.read(bufferSize, 1000 if not skipAll else 100)):
-				if skipAll:
-					continue
-
-				msg = lastMsg + byteArrToString(result)
-				unpackedMsg = unpackMsg(msg)
-				if not unpackedMsg:
-					continue
-
-				if not unpackedMsg.isEnd:
-					lastMsg = msg.strip()
-					continue
-				else:
-					lastMsg = ""
-
-				# ignore echoed commands:
-				if unpackedMsg.sender == MsgSender.HOST.value:
-					waitForEcho = False
-					bufferSize = echoSize + 8 if waitForEcho else minSize + 8
-					continue
-
-				# if this wasn't the wanted action
-				if wantedAction and unpackedMsg.action != wantedAction.value:
-					continue
-
-				return unpackedMsg
+			return device.setCapabilities(self.sendSingleMessage(device, MsgAction.HELLO, MsgOperation.NONE))
 		except Exception as e:
-			pass
+			print("Send Error:", e)
+		return False
+
+	def getCapabilities(self, device: USB_Device) -> Capabilities:
+		# clients that don't know HELLO keep the host's defaults
+		if not device.handshakeDone:
+			self.handshake(device)
+		return device.capabilities
+
+	def getCompression(self, devices: List[USB_Device]) -> Compression:
+		"""Returns the configured codec, or no compression if one of the devices can't decompress it."""
+		feature = {Compression.ZLIB: Feature.ZLIB, Compression.LZMA: Feature.LZMA}.get(self.compression)
+		if feature and not all(dev.hasFeature(feature) for dev in devices):
+			return Compression.NONE
+		return self.compression
+
+	def packMessage(
+		self,
+		action: MsgAction,
+		operation: MsgOperation,
+		data="",
+		requestId: int = 0,
+		stream: bool = False,
+		devices: List[USB_Device] = ()) -> Union[str, bytes]:
+
+		if self.protocol == ProtocolType.BINARY:
+			compression = self.getCompression(devices)
+			return packBinaryMsg(MsgSender.HOST, MsgStatus.OK, action, operation, data, requestId, compression, stream=stream)
+		return packMsg(MsgSender.HOST, MsgStatus.OK, action, operation, data)
+
+	def writeMessage(self, dev: USB_Device, pack: Union[str, bytes]):
+		dev.transport.write(pack)
+		dev.consumeCredits(len(pack))
+
+	def readMessage(
+		self,
+		dev: USB_Device,
+		skipAll: bool = False,
+		wantedAction: MsgAction = None,
+		echoSize: int = 8,
+		minSize: int = 0,
+		wantedIds: Container[int] = None,
+		timeout: int = None) -> UnpackedMsg:
+
+		decoder = dev.getDecoder(self.protocol)
+		if timeout is None:
+			timeout = dev.getTimeout(echoSize + minSize)
+		try:
+			if skipAll:
+				# leftovers are already on their way, so waiting for the shortest answers is enough
+				while dev.transport.receive(echoSize + 8, min(dev.getTimeout(), 100)):
+					pass
+				return
+
+			# without echo the answer can be read directly
+			waitForEcho = self.echo
+			headerSize = TEXT_MIN_FRAME_SIZE if self.protocol == ProtocolType.TEXT else BINARY_HEADER.size
+			bufferSize = dev.getReadSize(echoSize + headerSize if waitForEcho else minSize + headerSize)
+			while True:
+				for frame in decoder.frames():
+					unpackedMsg = decoder.unpack(frame)
+					if self.isWantedAnswer(dev, unpackedMsg, wantedAction, wantedIds):
+						return unpackedMsg
+
+					# the echo is complete, now the answer follows
+					if unpackedMsg.sender == MsgSender.HOST.value:
+						waitForEcho = False
+						bufferSize = dev.getReadSize(minSize + headerSize)
+
+				if not (result := dev.transport.receive(bufferSize, timeout)):
+					return
+				decoder.feed(result)
+		except Exception as e:
+			if isinstance(e, core.USBTimeoutError) and not skipAll:
+				dev.timeouts += 1
 			print("Timeout", e)
 			# print(traceback.format_exc())
+		finally:
+			if skipAll:
+				decoder.reset()
+
+	def isWantedAnswer(self, dev: USB_Device, unpackedMsg: UnpackedMsg, wantedAction: MsgAction = None, wantedIds: Container[int] = None) -> bool:
+		dev.grantCredits(unpackedMsg.credits)
+
+		# ignore echoed commands:
+		if unpackedMsg.sender == MsgSender.HOST.value:
+			return False
+
+		# if this wasn't the wanted action
+		if wantedAction and unpackedMsg.action != wantedAction.value:
+			return False
+
+		# if this is the answer to another (e.g. timed out) request
+		if wantedIds is not None and unpackedMsg.requestId not in wantedIds:
+			return False
+		return True
+
+	def getEchoSize(self, action: MsgAction, operation: MsgOperation, data="") -> int:
+		"""Returns how many bytes an echoing tty sends back for this request."""
+		pack = self.packMessage(action, operation, data)
+		# the line discipline turns the trailing "\r" of a text frame into "\r\n"
+		return len(pack) + 1 if self.protocol == ProtocolType.TEXT else len(pack)
+
+	def getSavedEchoSize(self, action: MsgAction, operation: MsgOperation, data="") -> int:
+		return 0 if self.echo else self.getEchoSize(action, operation, data)
 
 	def readAllMessages(self) -> List[MsgStatus]:
-		status = []
-		for dev in self.devices:
-			status.append(self.readMessage(dev))
-		return status
+		start = timer()
+		return self.gatherMessages(self.devices, [{} for _ in self.devices], [start + self.getBroadcastTimeout(dev) / 1000 for dev in self.devices])
+
+	def getBroadcastTimeout(self, dev: USB_Device, size: int = 0) -> int:
+		return min(dev.getTimeout(size), BROADCAST_TIMEOUT)
+
+	def gatherMessages(self, devices: List[USB_Device], readArgs: List[dict], deadlines: List[float]) -> List[UnpackedMsg]:
+		"""Reads one answer from every device, each device has a deadline instead of waiting after the others."""
+		answers = []
+		for dev, args, deadline in zip(devices, readArgs, deadlines):
+			if args is None:
+				answers.append(None)
+				continue
+			# answers that already arrived are still read, even after the deadline
+			answers.append(self.readMessage(dev, timeout=max(int((deadline - timer()) * 1000), 1), **args))
+		return answers
+
+	def broadcastMessage(
+		self,
+		devices: List[USB_Device],
+		action: MsgAction,
+		operation: MsgOperation,
+		data: str = "",
+		minSize: int = 0,
+		timeout: int = None) -> List[UnpackedMsg]:
+		"""
+		Sends the same request to all devices and gathers their answers.
+		All requests are written before the first answer is read, so the devices work concurrently.
+		Without a timeout every device waits as long as its round trip estimate allows.
+		Returns the answer of every device, None if it failed or timed out.
+		"""
+		requestId = 0
+		if self.protocol == ProtocolType.BINARY and devices:
+			# one request id that is new on every device, so the frame is only packed once
+			requestId = max(dev.requestId for dev in devices) % MAX_REQUEST_ID + 1
+		pack = self.packMessage(action, operation, data, requestId, devices=devices)
+
+		readArgs, starts = [], []
+		for dev in devices:
+			if requestId:
+				dev.requestId = requestId
+			starts.append(dev.startRequest())
+			try:
+				self.writeMessage(dev, pack)
+				readArgs.append(dict(wantedAction=action, echoSize=len(pack), minSize=minSize, wantedIds=(requestId,) if requestId else None))
+			except Exception as e:
+				print("Send Error:", e)
+				readArgs.append(None)
+
+		size = len(pack) + minSize
+		deadlines = [start + (timeout or self.getBroadcastTimeout(dev, size)) / 1000 for dev, start in zip(devices, starts)]
+		answers = self.gatherMessages(devices, readArgs, deadlines)
+		for dev, start, answer in zip(devices, starts, answers):
+			dev.finishRequest(start, answer is not None, size)
+		return answers
 
 	def sendMessage(
 		self,
@@ -117,56 +529,353 @@ class USB_Host:
 		id: int = -1,
 		minSize: int = 0) -> Union[None, UnpackedMsg, List[UnpackedMsg]]:
 
-		answers = []
+		if id < 0:
+			return self.broadcastMessage(self.getDevices(id), action, operation, data, minSize)
+
 		for dev in self.getDevices(id):
 			try:
-				pack = packMsg(MsgSender.HOST, MsgStatus.OK, action, operation, data)
-
-				t = dev.outEp.write(pack)
-				answer = self.readMessage(dev, wantedAction=action, echoSize=len(pack), minSize=minSize)
-
-				if id >= 0:
-					return answer
-				else:
-					answers.append(answer)
-
+				return self.sendSingleMessage(dev, action, operation, minSize, data)
 			except Exception as e:
 				pass
 				print("Send Error:", e)
 				# print(traceback.format_exc())
-		return answers
 
 	def sendSingleMessage(self, device: USB_Device, action: MsgAction, operation: MsgOperation, minSize: int = 0, data: str = ""):
-		pack = packMsg(MsgSender.HOST, MsgStatus.OK, action, operation, data)
-		t = device.outEp.write(pack)
-		answer = self.readMessage(device, wantedAction=action, echoSize=len(pack), minSize=minSize)
-		return answer
+		requestId = device.nextRequestId() if self.protocol == ProtocolType.BINARY else 0
+		pack = self.packMessage(action, operation, data, requestId, devices=[device])
+		answer = None
+		start = device.startRequest()
+		try:
+			self.writeMessage(device, pack)
+			answer = self.readMessage(device, wantedAction=action, echoSize=len(pack), minSize=minSize, wantedIds=(requestId,) if requestId else None)
+		finally:
+			rtt = device.finishRequest(start, answer is not None, len(pack) + minSize)
+		return answer._replace(rtt=rtt) if answer else answer
+
+	def streamMessage(self, device: USB_Device, action: MsgAction, operation: MsgOperation, data: str = "") -> Iterator[bytes]:
+		"""
+		Sends a request and yields the payload chunks of the streamed answer as they arrive.
+		If the protocol or client can't stream, the whole answer is yielded at once.
+		"""
+		capabilities = self.getCapabilities(device)
+		if self.protocol != ProtocolType.BINARY or not device.hasFeature(Feature.STREAM):
+			answer = self.sendSingleMessage(device, action, operation, 0, data)
+			if not answer or answer.status != MsgStatus.OK.value:
+				raise IOError("Request to device %s failed" % device.id)
+			yield answer.data
+			return
+
+		requestId = device.nextRequestId()
+		self.writeMessage(device, self.packMessage(action, operation, data, requestId, True, devices=[device]))
+		sequence = 0
+		chunkSize = capabilities.streamChunkSize if capabilities else STREAM_CHUNK_SIZE
+		while True:
+			answer = self.readMessage(device, minSize=chunkSize, wantedIds=(requestId,))
+			if not answer or answer.sequence != sequence:
+				raise IOError("Stream of device %s broke off at chunk %s" % (device.id, sequence))
+			if answer.status == MsgStatus.OK.value:
+				return
+			if answer.status != MsgStatus.ONGOING.value:
+				raise IOError("Stream of device %s failed at chunk %s" % (device.id, sequence))
+			yield answer.data
+			sequence += 1
+
+	def sendRequests(self, device: USB_Device, requests: List[Tuple[MsgAction, MsgOperation, str, int]]) -> List[UnpackedMsg]:
+		"""
+		Sends (action, operation, data, minSize) requests to a single device, keeping up to maxInFlight of them unanswered.
+		Only as many bytes as the client granted credits for are send ahead.
+		Answers are matched by their request id, so they may arrive in any order.
+		"""
+		results: List[UnpackedMsg] = [None] * len(requests)
+		if self.maxInFlight <= 1:
+			for i, (action, operation, data, minSize) in enumerate(requests):
+				results[i] = self.sendSingleMessage(device, action, operation, minSize, data)
+			return results
+
+		pending: Dict[int, int] = {}
+		starts: Dict[int, float] = {}
+		nextIndex = 0
+		nextPack: Tuple[int, bytes] = None
+		readSize = max((request[3] for request in requests), default=0)
+		# the largest request decides which round trip estimate the reads wait for
+		transferSize = readSize
+		try:
+			while nextIndex < len(requests) or pending:
+				while nextIndex < len(requests) and len(pending) < self.maxInFlight:
+					if not nextPack:
+						action, operation, data, _ = requests[nextIndex]
+						requestId = device.nextRequestId()
+						nextPack = (requestId, self.packMessage(action, operation, data, requestId, devices=[device]))
+					requestId, pack = nextPack
+
+					# wait for credits, unless nothing is pending (then the frame would never fit)
+					if pending and len(pack) > device.getCredits():
+						break
+					transferSize = max(transferSize, len(pack) + readSize)
+					starts[requestId] = device.startRequest()
+					self.writeMessage(device, pack)
+					pending[requestId] = nextIndex
+					nextIndex += 1
+					nextPack = None
+
+				answer = self.readMessage(device, minSize=readSize, wantedIds=pending, timeout=device.getTimeout(transferSize))
+				if not answer:
+					# timeout, all unanswered requests are lost
+					break
+				rtt = device.finishRequest(starts.pop(answer.requestId), True, transferSize)
+				results[pending.pop(answer.requestId)] = answer._replace(rtt=rtt)
+		except Exception as e:
+			pass
+			print("Send Error:", e)
+		finally:
+			for start in starts.values():
+				device.finishRequest(start, False, transferSize)
+		return results
 
-	def requestClientAction(self, operation: MsgOperation, maxDevices: int = -1, data: str = "", count: int = 0):
+	def packBatch(self, requests: List[Tuple[MsgOperation, str]]) -> bytes:
+		# the position inside the batch is used as request id
+		return b"".join(
+			packBinaryMsg(MsgSender.HOST, MsgStatus.OK, MsgAction.CALCULATE, operation, data, i) for i, (operation, data) in enumerate(requests)
+		)
+
+	def sendBatch(self, device: USB_Device, requests: List[Tuple[MsgOperation, str]], minSize: int = 0) -> List[UnpackedMsg]:
+		"""Sends (operation, data) CALCULATE requests to a single device in one frame and returns the answers in the same order."""
+		return self.sendBatches(device, [requests], minSize)
+
+	def sendBatches(self, device: USB_Device, batches: List[List[Tuple[MsgOperation, str]]], minSize: int = 0) -> List[UnpackedMsg]:
+		if self.protocol != ProtocolType.BINARY or not device.hasFeature(Feature.BATCH):
+			requests = [request for batch in batches for request in batch]
+			return self.sendRequests(device, [(MsgAction.CALCULATE, operation, data, 0) for operation, data in requests])
+
+		answers = self.sendRequests(device, self.getBatchRequests(batches, minSize))
+		return self.unpackBatchAnswers(batches, answers)
+
+	def getBatchRequests(self, batches: List[List[Tuple[MsgOperation, str]]], minSize: int = 0) -> List[Tuple[MsgAction, MsgOperation, bytes, int]]:
+		return [(MsgAction.BATCH, MsgOperation.NONE, self.packBatch(batch), minSize) for batch in batches]
+
+	def unpackBatchAnswers(self, batches: List[List[Tuple[MsgOperation, str]]], answers: List[UnpackedMsg]) -> List[UnpackedMsg]:
+		results: List[UnpackedMsg] = []
+		for batch, answer in zip(batches, answers):
+			batchResults: List[UnpackedMsg] = [None] * len(batch)
+			if answer and answer.status == MsgStatus.OK.value:
+				for unpackedMsg in unpackBatch(answer.data):
+					if unpackedMsg.requestId < len(batch):
+						# all loads of a batch are answered at once
+						batchResults[unpackedMsg.requestId] = unpackedMsg._replace(rtt=answer.rtt)
+			results += batchResults
+		return results
+
+	def getBatchSize(self, device: USB_Device, operation: MsgOperation, data: str) -> int:
+		capabilities = self.getCapabilities(device)
+		if self.batchSize <= 1 or not capabilities:
+			return self.batchSize
+		if not device.hasFeature(Feature.BATCH):
+			return 1
+		# the whole batch has to fit into a single frame the client accepts
+		requestSize = len(self.packMessage(MsgAction.CALCULATE, operation, data, devices=[device]))
+		return max(1, min(self.batchSize, capabilities.maxBatchSize, (capabilities.maxFrameSize - BINARY_HEADER.size) // requestSize))
+
+	def getDeviceLoads(self, actionCount: int) -> List[int]:
+		"""Returns how many of the actions each device has to process."""
+		count = self.getCount()
+		devicesReady = self.devices and len(self.devices) == count
+		# devices with an open circuit only get loads if all of them are open
+		available = [i for i in range(count) if not self.devices[i].breaker.isOpen()] if devicesReady else []
+		if len(available) in (0, count):
+			if self.deviceSelection == DeviceSelection.ROUND_ROBIN or not devicesReady:
+				return [actionCount // count + (1 if i < actionCount % count else 0) for i in range(min(actionCount, count))]
+			available = list(range(count))
+
+		loads = [0] * count
+		if self.deviceSelection == DeviceSelection.ROUND_ROBIN:
+			for i in range(actionCount):
+				loads[available[i % len(available)]] += 1
+			return loads
+
+		# devices without a measured round trip time are assumed to be as fast as the others
+		rtts = [dev.rtt for dev in self.devices if dev.rtt is not None]
+		defaultRtt = sum(rtts) / len(rtts) if rtts else 1.0
+		for _ in range(actionCount):
+			loads[self.selectDevice(loads, defaultRtt, available)] += 1
+		return loads
+
+	def selectDevice(self, loads: List[int], defaultRtt: float, available: List[int]) -> int:
+		if self.deviceSelection == DeviceSelection.POWER_OF_TWO and len(available) > 2:
+			candidates = random.sample(available, 2)
+		else:
+			candidates = available
+		return min(candidates, key=lambda i: self.devices[i].getExpectedDelay(loads[i], defaultRtt))
+
+	def processDeviceLoads(self, device: USB_Device, operation: MsgOperation, data: str, count: int, loadCount: int) -> List[UnpackedMsg]:
+		if not loadCount:
+			return []
 		# do time intensive calculations on the host
+		dataLen = int(data)
+		requests = [(MsgAction.CALCULATE, operation, data, dataLen)] * loadCount
+		available = dataLen <= 0 or self.checkCircuit(device)
+		batchSize = self.getBatchSize(device, operation, data) if dataLen > 0 and available else 1
+		if not available:
+			results = [None] * loadCount
+		elif dataLen > 0 and not device.supports(operation):
+			print("Device %s does not support operation %s" % (device.id, getEnumValue(operation)))
+			results = [None] * loadCount
+		elif dataLen > 0 and batchSize > 1:
+			batches = [[(operation, data)] * min(batchSize, loadCount - i) for i in range(0, loadCount, batchSize)]
+			results = self.retryRequests(device, requests, self.sendBatches(device, batches, (dataLen + BINARY_HEADER.size) * len(batches[0])))
+		elif dataLen > 0:
+			results = self.retryRequests(device, requests, self.sendRequests(device, requests))
+		else:
+			results = [UnpackedMsg(True, True, -1, -1, -1, -1, "")] * loadCount
+		return self.finishDeviceLoads(operation, count, loadCount, results)
+
+	def retryRequests(self, device: USB_Device, requests: List[Tuple[MsgAction, MsgOperation, str, int]], results: List[UnpackedMsg]) -> List[UnpackedMsg]:
+		"""Sends the requests without an answer again, as long as the retry policy and the device's circuit allow."""
+		for attempt in range(self.retryPolicy.retries):
+			failed = [i for i, result in enumerate(results) if result is None]
+			if not failed or device.breaker.isOpen():
+				break
+			time.sleep(self.retryPolicy.getDelay(attempt))
+			for i, answer in zip(failed, self.sendRequests(device, [requests[i] for i in failed])):
+				results[i] = answer
+		return results
+
+	def checkCircuit(self, device: USB_Device) -> bool:
+		"""Returns if the device may take loads, a device out of rotation is pinged once its probe is due."""
+		if not device.breaker.isOpen():
+			return True
+		if device.breaker.isProbeDue():
+			try:
+				self.sendSingleMessage(device, MsgAction.PING, MsgOperation.NONE)
+			except Exception as e:
+				print("Send Error:", e)
+		return not device.breaker.isOpen()
+
+	def finishDeviceLoads(self, operation: MsgOperation, count: int, loadCount: int, results: List[UnpackedMsg]) -> List[UnpackedMsg]:
+		if operation == MsgOperation.TESTLOAD:
+			# the calculation of these loads overlaps with the transfers of the next ones, see waitForCompute
+			if self.useComputePool:
+				self.computeFutures.append(self.getComputePool().submit(calculateLoads, count, loadCount))
+			else:
+				self.computeTimes += calculateLoads(count, loadCount)
+			# test loads are verified by their checksum, so the payloads do not have to be kept
+			results = [stripPayload(result) for result in results]
+		return results
+
+	def getComputePool(self) -> ProcessPoolExecutor:
+		if self.computePool is None:
+			# a fork server, because the host forks from its worker threads otherwise,
+			# the host may have been limited to fewer cores since the import (see SetHostCores)
+			processCount = min(COMPUTE_PROCESS_COUNT, len(os.sched_getaffinity(0)))
+			self.computePool = ProcessPoolExecutor(processCount, mp_context=get_context("forkserver"))
+		return self.computePool
+
+	def waitForCompute(self) -> List[float]:
+		"""Waits until the host side calculations of all processed loads are done and returns the time each one took."""
+		while self.computeFutures:
+			self.computeTimes += self.computeFutures.pop(0).result()
+		times, self.computeTimes = self.computeTimes, []
+		return times
+
+	def requestClientAction(self, operation: MsgOperation, maxDevices: int = -1, data: str = "", count: int = 0):
 		answers = []
 		actionCount = maxDevices if maxDevices >= 0 else self.getCount()
-		for i in range(actionCount):
-			dataLen = int(data)
-			if dataLen > 0:
-				answers.append(self.sendMessage(MsgAction.CALCULATE, operation, data, i, minSize=dataLen))
-			else:
-				answers.append(UnpackedMsg._make([True, True, -1, -1, -1, -1, ""]))
-			if operation == MsgOperation.TESTLOAD:
-				calculate(count)
+		for device, loadCount in zip(self.getDevices(-1), self.getDeviceLoads(actionCount)):
+			answers += self.processDeviceLoads(device, operation, data, count, loadCount)
 		return answers
 
+	def processLoadQueue(self, operation: MsgOperation, loadCount: int, data: str = "", count: int = 0) -> Tuple[List[UnpackedMsg], List[float]]:
+		"""
+		Processes loadCount loads without rounds: every device takes its next loads from a shared queue as soon as it is done.
+		Returns the answers and the time every load took on its device.
+		"""
+		self.loadQueue.reset(loadCount)
+		answers, times = [], []
+		# a single thread can only take turns
+		devices = self.getDevices(-1)
+		while any([self.processQueuedChunk(device, operation, data, count, answers, times) for device in devices]):
+			pass
+		return answers, times
+
+	def processQueuedChunk(self, device: USB_Device, operation: MsgOperation, data: str, count: int, answers: List[UnpackedMsg], times: List[float]) -> bool:
+		# a device out of rotation leaves its share to the others
+		if not self.checkCircuit(device) or not (loadCount := self.loadQueue.take(self.getQueueChunk())):
+			return False
+		results = self.processDeviceLoads(device, operation, data, count, loadCount)
+		answers += results
+		times += getLoadTimes(results)
+		return True
+
+	def processQueuedLoads(self, device: USB_Device, operation: MsgOperation, data: str, count: int) -> Tuple[List[UnpackedMsg], List[float]]:
+		answers, times = [], []
+		while self.processQueuedChunk(device, operation, data, count, answers, times):
+			pass
+		return answers, times
+
 	def clearMessages(self, id: int = -1):
 		with suppress_stdout():
 			for dev in self.getDevices(id):
 				self.readMessage(dev, True)
 
+	def refreshDevices(self) -> List[USB_Device]:
+		"""Picks up gadgets that appeared or disappeared, known devices keep their state."""
+		if self.transportType != TransportType.USB:
+			# local transports are created once and don't change
+			if not self.devices:
+				self.devices = [USB_Device(i, transport=MakeTransport(self.transportType, self.echo)) for i in range(self.count)]
+			return self.devices
+
+		RefreshDevices()
+		self.refreshedAt = timer()
+		known = {dev.key: dev for dev in self.devices or []}
+		self.devices: List[USB_Device] = []
+		for i, key in enumerate(DEVICE_REGISTRY.getKeys()):
+			dev = known.pop(key, None) or USB_Device(i, DEVICE_REGISTRY.getDevice(key), key, useLibusb=self.useLibusb)
+			dev.id = i
+			self.devices.append(dev)
+		# whatever is left was unplugged
+		for dev in known.values():
+			self.removeDevice(dev)
+		self.count = len(self.devices)
+		return self.devices
+
+	def isRefreshDue(self) -> bool:
+		return self.transportType == TransportType.USB and timer() - self.refreshedAt >= DEVICE_REFRESH_INTERVAL
+
+	def removeDevice(self, dev: USB_Device):
+		dev.transport.close()
+
+	def takeTransferCounts(self) -> Tuple[int, int]:
+		"""Returns the IN transfers and receive buffer allocations of all devices since the last call."""
+		counts = [dev.transport.takeCounts() for dev in self.devices or []]
+		return sum(transfers for transfers, _ in counts), sum(allocations for _, allocations in counts)
+
+	def takeTimeoutCount(self) -> int:
+		"""Returns how many reads of all devices timed out since the last call."""
+		timeouts = sum(dev.timeouts for dev in self.devices or [])
+		for dev in self.devices or []:
+			dev.timeouts = 0
+		return timeouts
+
+	def getClientFiles(self) -> List[Union[str, int]]:
+		return [dev.transport.getClientFile() for dev in self.getDevices(-1)]
+
+	def getTransferMode(self) -> str:
+		"""Describes how the transfers wait for the devices, printed with the measurements."""
+		if self.transportType != TransportType.USB:
+			return "%s transport" % self.transportType.value
+		return "libusb transfers" if self.useLibusb and LIBUSB_AVAILABLE else "pyusb transfers"
+
+	def close(self):
+		# device handles stay open for the host's lifetime and are only released here
+		for dev in self.devices or []:
+			dev.transport.close()
+		if self.computePool is not None:
+			self.computePool.shutdown()
+			self.computePool = None
+
 	def getDevices(self, id: int) -> List[USB_Device]:
-		if not self.devices:
-			devices = GetAllDevices()
-			self.devices: List[USB_Device] = []
-			for i, dev in enumerate(devices):
-				self.devices.append(USB_Device(i, dev))
+		if not self.devices or self.isRefreshDue():
+			self.refreshDevices()
 
 		devices = []
 		if id < 0:
@@ -179,37 +888,43 @@ class USB_Host:
 
 class USB_Host_Threading(USB_Host):
 
-	def clearMessages(self, id: int = -1):
-		with suppress_stdout():
-			for dev in self.getDevices(id):
-				self.readMessage(dev, True)
-				dev.device.finalize()
+	def __init__(self, count, *args, **kwargs):
+		super().__init__(count, *args, **kwargs)
+		# one long-lived worker per device, so every device is always used by the same thread
+		self.workers: List[ThreadPoolExecutor] = []
+
+	def prepareDevices(self):
+		super().prepareDevices()
+		self.getWorkers()
+
+	def getWorkers(self) -> List[ThreadPoolExecutor]:
+		devices = self.getDevices(-1)
+		for i in range(len(self.workers), len(devices)):
+			self.workers.append(ThreadPoolExecutor(max_workers=1, thread_name_prefix="USB_Device_%s" % i))
+		return self.workers
 
 	def processRequests(self, operation: MsgOperation, actionCount: int, data: str = "", count: int = 0):
-		results: List[UnpackedMsg] = [None] * self.getCount()
-		threads: List[threading.Thread] = []
-		for i in range(actionCount):
-			t = threading.Thread(target=self.processSingleRequest, args=(i, results, operation, data, count))
-			threads.append(t)
-			t.start()
-		for t in threads:
-			t.join()
+		# a refresh of the devices happens before the loads are spread over them
+		workers = self.getWorkers()
+		deviceLoads = self.getDeviceLoads(actionCount)
+		futures = [workers[i].submit(self.processSingleRequest, i, operation, data, count, loadCount) for i, loadCount in enumerate(deviceLoads)]
 
-		return results
+		return [result for future in futures for result in future.result()]
 
-	def processSingleRequest(self, index: int, results: List[UnpackedMsg], operation: MsgOperation, data: str, count: int):
-		# do time intensive calculations on the host
-		dataLen = int(data)
-		device = self.devices[index]
-		if dataLen > 0:
-			results[index] = self.sendSingleMessage(device, MsgAction.CALCULATE, operation, dataLen, data)
-		else:
-			results[index] = UnpackedMsg._make([True, True, -1, -1, -1, -1, ""])
+	def processSingleRequest(self, index: int, operation: MsgOperation, data: str, count: int, loadCount: int = 1):
+		return self.processDeviceLoads(self.devices[index], operation, data, count, loadCount)
 
-		if operation == MsgOperation.TESTLOAD:
-			calculate(count)
+	def processLoadQueue(self, operation: MsgOperation, loadCount: int, data: str = "", count: int = 0) -> Tuple[List[UnpackedMsg], List[float]]:
+		self.loadQueue.reset(loadCount)
+		workers = self.getWorkers()
+		futures = [worker.submit(self.processQueuedLoads, device, operation, data, count) for device, worker in zip(self.devices, workers)]
+		return mergeQueuedResults(future.result() for future in futures)
 
-		device.device.finalize()
+	def close(self):
+		for worker in self.workers:
+			worker.shutdown()
+		self.workers = []
+		super().close()
 
 	def requestClientAction(self, operation: MsgOperation, maxDevices: int = -1, data: str = "", count: int = 0):
 		actionCount = maxDevices if maxDevices >= 0 else self.getCount()
@@ -217,12 +932,35 @@ class USB_Host_Threading(USB_Host):
 
 
 class USB_Host_Asyncio(USB_Host):
-
-	def clearMessages(self, id: int = -1):
-		with suppress_stdout():
-			for dev in self.getDevices(id):
-				self.readMessage(dev, True)
-				dev.device.finalize()
+	"""Drives all devices from a single event loop, every read and write is awaited on the transport."""
+
+	def __init__(self, count, *args, **kwargs):
+		super().__init__(count, *args, **kwargs)
+		# libusb completes the transfers on the loop, pyusb blocks a thread for each of them
+		self.useLibusb = LIBUSB_AVAILABLE
+		self.transferExecutor: ThreadPoolExecutor = None
+
+	def getTransferExecutor(self) -> ThreadPoolExecutor:
+		# the default executor has fewer threads than there can be devices, every device needs one to wait for its transfers
+		if not self.transferExecutor:
+			self.transferExecutor = ThreadPoolExecutor(max_workers=self.getCount(), thread_name_prefix="USB_Transfer")
+		return self.transferExecutor
+
+	def getTransport(self, dev: USB_Device) -> Transport:
+		if not dev.transport.executor and not dev.transport.hasAsyncTransfers():
+			dev.transport.executor = self.getTransferExecutor()
+		return dev.transport
+
+	def getTransferMode(self) -> str:
+		if self.transportType == TransportType.USB and not self.useLibusb and not USE_ASYNC_THREADPOOL:
+			return "pyusb transfers on a pool of %s threads" % self.getCount()
+		return super().getTransferMode()
+
+	def close(self):
+		super().close()
+		if self.transferExecutor:
+			self.transferExecutor.shutdown()
+			self.transferExecutor = None
 
 	def processRequests(self, operation: MsgOperation, actionCount: int, data: str = "", count: int = 0):
 		loop = asyncio.new_event_loop()
@@ -235,59 +973,240 @@ class USB_Host_Asyncio(USB_Host):
 
 	async def processRequestsAsync(self, operation: MsgOperation, actionCount: int, data: str, count: int):
 		results = []
+		deviceLoads = self.getDeviceLoads(actionCount)
 		if USE_ASYNC_THREADPOOL:
-			with ThreadPoolExecutor(max_workers=actionCount) as executor:
+			with ThreadPoolExecutor(max_workers=len(deviceLoads)) as executor:
 				loop = asyncio.get_event_loop()
 				tasks = [
 					loop.run_in_executor(
 						executor,
 						self.processSingleRequest,
-						*(id, operation, data, count)
+						*(id, operation, data, count, loadCount)
 					)
-					for id in range(actionCount)
+					for id, loadCount in enumerate(deviceLoads)
 				]
 				for response in await asyncio.gather(*tasks):
-					results.append(response)
+					results += response
 		else:
-			tasks = []
-			for i in range(actionCount):
-				task = asyncio.create_task(self.processSingleRequestAsync(i, operation, data, count))
-				tasks.append(task)
-			for task in tasks:
-				results.append(await task)
+			tasks = [self.processSingleRequestAsync(i, operation, data, count, loadCount) for i, loadCount in enumerate(deviceLoads)]
+			for response in await asyncio.gather(*tasks):
+				results += response
 		return results
 
-	async def processSingleRequestAsync(self, index: int, operation: MsgOperation, data: str, count: int):
-		dataLen = int(data)
-		device = self.devices[index]
-		if dataLen > 0:
-			result = self.sendSingleMessage(device, MsgAction.CALCULATE, operation, dataLen, data)
-		else:
-			result = UnpackedMsg._make([True, True, -1, -1, -1, -1, ""])
+	async def processSingleRequestAsync(self, index: int, operation: MsgOperation, data: str, count: int, loadCount: int = 1):
+		return await self.processDeviceLoadsAsync(self.devices[index], operation, data, count, loadCount)
 
-		if operation == MsgOperation.TESTLOAD:
-			calculate(count)
+	def processSingleRequest(self, index: int, operation: MsgOperation, data: str, count: int, loadCount: int = 1):
+		return self.processDeviceLoads(self.devices[index], operation, data, count, loadCount)
 
-		device.device.finalize()
-		return result
+	def processLoadQueue(self, operation: MsgOperation, loadCount: int, data: str = "", count: int = 0) -> Tuple[List[UnpackedMsg], List[float]]:
+		self.loadQueue.reset(loadCount)
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		return loop.run_until_complete(self.processLoadQueueAsync(self.getDevices(-1), operation, data, count))
 
-	def processSingleRequest(self, index: int, operation: MsgOperation, data: str, count: int):
+	async def processLoadQueueAsync(self, devices: List[USB_Device], operation: MsgOperation, data: str, count: int) -> Tuple[List[UnpackedMsg], List[float]]:
+		if USE_ASYNC_THREADPOOL:
+			with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+				loop = asyncio.get_event_loop()
+				tasks = [loop.run_in_executor(executor, self.processQueuedLoads, device, operation, data, count) for device in devices]
+				return mergeQueuedResults(await asyncio.gather(*tasks))
+		return mergeQueuedResults(await asyncio.gather(*[self.processQueuedLoadsAsync(device, operation, data, count) for device in devices]))
+
+	async def processQueuedLoadsAsync(self, device: USB_Device, operation: MsgOperation, data: str, count: int) -> Tuple[List[UnpackedMsg], List[float]]:
+		answers, times = [], []
+		while await self.checkCircuitAsync(device) and (loadCount := self.loadQueue.take(self.getQueueChunk())):
+			results = await self.processDeviceLoadsAsync(device, operation, data, count, loadCount)
+			answers += results
+			times += getLoadTimes(results)
+		return answers, times
+
+	async def processDeviceLoadsAsync(self, device: USB_Device, operation: MsgOperation, data: str, count: int, loadCount: int) -> List[UnpackedMsg]:
+		if not loadCount:
+			return []
 		dataLen = int(data)
-		device = self.devices[index]
-		if dataLen > 0:
-			result = self.sendSingleMessage(device, MsgAction.CALCULATE, operation, dataLen, data)
+		requests = [(MsgAction.CALCULATE, operation, data, dataLen)] * loadCount
+		available = dataLen <= 0 or await self.checkCircuitAsync(device)
+		if dataLen > 0 and available and not device.handshakeDone:
+			await self.handshakeAsync(device)
+		batchSize = self.getBatchSize(device, operation, data) if dataLen > 0 and available else 1
+		if not available:
+			results = [None] * loadCount
+		elif dataLen > 0 and not device.supports(operation):
+			print("Device %s does not support operation %s" % (device.id, getEnumValue(operation)))
+			results = [None] * loadCount
+		elif dataLen > 0 and batchSize > 1:
+			batches = [[(operation, data)] * min(batchSize, loadCount - i) for i in range(0, loadCount, batchSize)]
+			results = await self.retryRequestsAsync(device, requests, await self.sendBatchesAsync(device, batches, (dataLen + BINARY_HEADER.size) * len(batches[0])))
+		elif dataLen > 0:
+			results = await self.retryRequestsAsync(device, requests, await self.sendRequestsAsync(device, requests))
 		else:
-			result = UnpackedMsg._make([True, True, -1, -1, -1, -1, ""])
+			results = [UnpackedMsg(True, True, -1, -1, -1, -1, "")] * loadCount
+		return await self.finishDeviceLoadsAsync(operation, count, loadCount, results)
+
+	async def finishDeviceLoadsAsync(self, operation: MsgOperation, count: int, loadCount: int, results: List[UnpackedMsg]) -> List[UnpackedMsg]:
+		if operation == MsgOperation.TESTLOAD and not self.useComputePool:
+			# on the loop the calculation would hold up the reads of all other devices, until their timeouts hit
+			self.computeTimes += await asyncio.get_event_loop().run_in_executor(None, calculateLoads, count, loadCount)
+			return [stripPayload(result) for result in results]
+		return self.finishDeviceLoads(operation, count, loadCount, results)
+
+	async def retryRequestsAsync(self, device: USB_Device, requests: List[Tuple[MsgAction, MsgOperation, str, int]], results: List[UnpackedMsg]) -> List[UnpackedMsg]:
+		for attempt in range(self.retryPolicy.retries):
+			failed = [i for i, result in enumerate(results) if result is None]
+			if not failed or device.breaker.isOpen():
+				break
+			await asyncio.sleep(self.retryPolicy.getDelay(attempt))
+			for i, answer in zip(failed, await self.sendRequestsAsync(device, [requests[i] for i in failed])):
+				results[i] = answer
+		return results
 
-		if operation == MsgOperation.TESTLOAD:
-			calculate(count)
+	async def checkCircuitAsync(self, device: USB_Device) -> bool:
+		if not device.breaker.isOpen():
+			return True
+		if device.breaker.isProbeDue():
+			try:
+				await self.sendSingleMessageAsync(device, MsgAction.PING, MsgOperation.NONE)
+			except Exception as e:
+				print("Send Error:", e)
+		return not device.breaker.isOpen()
 
-		device.device.finalize()
-		return result
+	async def handshakeAsync(self, device: USB_Device) -> bool:
+		device.handshakeDone = True
+		try:
+			return device.setCapabilities(await self.sendSingleMessageAsync(device, MsgAction.HELLO, MsgOperation.NONE))
+		except Exception as e:
+			print("Send Error:", e)
+		return False
 
-	def requestClientAction(self, operation: MsgOperation, maxDevices: int = -1, data: str = "", count: int = 0):
-		actionCount = maxDevices if maxDevices >= 0 else self.getCount()
-		return self.processRequests(operation, actionCount, data, count)
+	async def writeMessageAsync(self, dev: USB_Device, pack: Union[str, bytes]):
+		await self.getTransport(dev).writeAsync(pack)
+		dev.consumeCredits(len(pack))
+
+	async def readMessageAsync(
+		self,
+		dev: USB_Device,
+		wantedAction: MsgAction = None,
+		echoSize: int = 8,
+		minSize: int = 0,
+		wantedIds: Container[int] = None,
+		timeout: int = None) -> UnpackedMsg:
+
+		decoder = dev.getDecoder(self.protocol)
+		if timeout is None:
+			timeout = dev.getTimeout(echoSize + minSize)
+		try:
+			waitForEcho = self.echo
+			headerSize = TEXT_MIN_FRAME_SIZE if self.protocol == ProtocolType.TEXT else BINARY_HEADER.size
+			bufferSize = dev.getReadSize(echoSize + headerSize if waitForEcho else minSize + headerSize)
+			while True:
+				for frame in decoder.frames():
+					unpackedMsg = decoder.unpack(frame)
+					if self.isWantedAnswer(dev, unpackedMsg, wantedAction, wantedIds):
+						return unpackedMsg
+
+					if unpackedMsg.sender == MsgSender.HOST.value:
+						waitForEcho = False
+						bufferSize = dev.getReadSize(minSize + headerSize)
+
+				if not (result := await self.getTransport(dev).receiveAsync(bufferSize, timeout)):
+					return
+				decoder.feed(result)
+		except Exception as e:
+			if isinstance(e, core.USBTimeoutError):
+				dev.timeouts += 1
+			print("Timeout", e)
+
+	async def sendSingleMessageAsync(self, device: USB_Device, action: MsgAction, operation: MsgOperation, minSize: int = 0, data: str = ""):
+		requestId = device.nextRequestId() if self.protocol == ProtocolType.BINARY else 0
+		pack = self.packMessage(action, operation, data, requestId, devices=[device])
+		answer = None
+		start = device.startRequest()
+		try:
+			await self.writeMessageAsync(device, pack)
+			answer = await self.readMessageAsync(device, action, len(pack), minSize, (requestId,) if requestId else None)
+		finally:
+			rtt = device.finishRequest(start, answer is not None, len(pack) + minSize)
+		return answer._replace(rtt=rtt) if answer else answer
+
+	async def sendRequestsAsync(self, device: USB_Device, requests: List[Tuple[MsgAction, MsgOperation, str, int]]) -> List[UnpackedMsg]:
+		"""Same as sendRequests, but waits for the device without blocking the other devices."""
+		results: List[UnpackedMsg] = [None] * len(requests)
+		if self.maxInFlight <= 1:
+			for i, (action, operation, data, minSize) in enumerate(requests):
+				results[i] = await self.sendSingleMessageAsync(device, action, operation, minSize, data)
+			return results
+
+		pending: Dict[int, int] = {}
+		starts: Dict[int, float] = {}
+		nextIndex = 0
+		nextPack: Tuple[int, bytes] = None
+		readSize = max((request[3] for request in requests), default=0)
+		# the largest request decides which round trip estimate the reads wait for
+		transferSize = readSize
+		try:
+			while nextIndex < len(requests) or pending:
+				while nextIndex < len(requests) and len(pending) < self.maxInFlight:
+					if not nextPack:
+						action, operation, data, _ = requests[nextIndex]
+						requestId = device.nextRequestId()
+						nextPack = (requestId, self.packMessage(action, operation, data, requestId, devices=[device]))
+					requestId, pack = nextPack
+
+					if pending and len(pack) > device.getCredits():
+						break
+					transferSize = max(transferSize, len(pack) + readSize)
+					starts[requestId] = device.startRequest()
+					await self.writeMessageAsync(device, pack)
+					pending[requestId] = nextIndex
+					nextIndex += 1
+					nextPack = None
+
+				answer = await self.readMessageAsync(device, minSize=readSize, wantedIds=pending, timeout=device.getTimeout(transferSize))
+				if not answer:
+					break
+				rtt = device.finishRequest(starts.pop(answer.requestId), True, transferSize)
+				results[pending.pop(answer.requestId)] = answer._replace(rtt=rtt)
+		except Exception as e:
+			print("Send Error:", e)
+		finally:
+			for start in starts.values():
+				device.finishRequest(start, False, transferSize)
+		return results
+
+	async def streamMessageAsync(self, device: USB_Device, action: MsgAction, operation: MsgOperation, data: str = "") -> AsyncIterator[bytes]:
+		"""Same as streamMessage, but every chunk is awaited without blocking the other devices."""
+		if not device.handshakeDone:
+			await self.handshakeAsync(device)
+		if self.protocol != ProtocolType.BINARY or not device.hasFeature(Feature.STREAM):
+			answer = await self.sendSingleMessageAsync(device, action, operation, 0, data)
+			if not answer or answer.status != MsgStatus.OK.value:
+				raise IOError("Request to device %s failed" % device.id)
+			yield answer.data
+			return
+
+		requestId = device.nextRequestId()
+		await self.writeMessageAsync(device, self.packMessage(action, operation, data, requestId, True, devices=[device]))
+		sequence = 0
+		chunkSize = device.capabilities.streamChunkSize if device.capabilities else STREAM_CHUNK_SIZE
+		while True:
+			answer = await self.readMessageAsync(device, minSize=chunkSize, wantedIds=(requestId,))
+			if not answer or answer.sequence != sequence:
+				raise IOError("Stream of device %s broke off at chunk %s" % (device.id, sequence))
+			if answer.status == MsgStatus.OK.value:
+				return
+			if answer.status != MsgStatus.ONGOING.value:
+				raise IOError("Stream of device %s failed at chunk %s" % (device.id, sequence))
+			yield answer.data
+			sequence += 1
+
+	async def sendBatchesAsync(self, device: USB_Device, batches: List[List[Tuple[MsgOperation, str]]], minSize: int = 0) -> List[UnpackedMsg]:
+		if self.protocol != ProtocolType.BINARY or not device.hasFeature(Feature.BATCH):
+			requests = [request for batch in batches for request in batch]
+			return await self.sendRequestsAsync(device, [(MsgAction.CALCULATE, operation, data, 0) for operation, data in requests])
+
+		answers = await self.sendRequestsAsync(device, self.getBatchRequests(batches, minSize))
+		return self.unpackBatchAnswers(batches, answers)
 
 	def requestClientAction(self, operation: MsgOperation, maxDevices: int = -1, data: str = "", count: int = 0):
 		actionCount = maxDevices if maxDevices >= 0 else self.getCount()
@@ -296,104 +1215,265 @@ class USB_Host_Asyncio(USB_Host):
 
 class USB_Host_Multiprocessing(USB_Host):
 
-	def __init__(self, count):
-		self.devices = None
-		self.count = count
+	def __init__(self, count, *args, **kwargs):
+		super().__init__(count, *args, **kwargs)
 		self.workerCount = count
-		self.pCount = 6
+		# the worker processes already calculate next to each other
+		self.useComputePool = False
+		# IN transfers, receive buffer allocations and timed out reads the workers reported since they were taken
+		self.workerCounts = [0, 0, 0]
 
 	def prepareDevices(self):
 		self.test = False
+		if self.transportType == TransportType.USB:
+			# only enumerate, the gadgets are opened by the workers, handles opened here would be shared by all of them
+			DEVICE_REGISTRY.getKeys()
+		else:
+			self.getDevices(-1)
 
+		# jobs and results travel through shared memory, idle workers just wait on the job ring's semaphore
 		self.processes: List[Process] = []
-		self.cons: List[Tuple[Connection, Connection]] = []
+		self.rings: List[Tuple[SharedRing, SharedRing]] = []
 		for i in range(self.workerCount):
-			recvCon, sendCon = Pipe(False)
-			sRecvCon, sSendCon = Pipe(False)
-			process = Process(target=self.handleProcess, args=(i, sendCon, sRecvCon))
+			jobRing, resultRing = SharedRing(), SharedRing()
+			process = Process(target=self.handleProcess, args=(i, jobRing, resultRing))
 			self.processes.append(process)
-			self.cons.append((recvCon, sSendCon))
+			self.rings.append((jobRing, resultRing))
 			process.start()
 
-		for i in range(self.workerCount):
-			con, _ = self.cons[i]
-			process = self.processes[i]
-			con.recv()
-			ps = psutil.Process(process.pid)
-			ps.suspend()
+		for _, resultRing in self.rings:
+			getResults(resultRing)
 
 	def deactivate(self, id: int = -1) -> Union[MsgStatus, List[MsgStatus]]:
-		for i in range(self.workerCount):
-			_, sendCon = self.cons[i]
-			process = self.processes[i]
-			ps = psutil.Process(process.pid)
-			ps.resume()
-			sendCon.send((MsgOperation.NONE, None, None))
+		for jobRing, _ in self.rings:
+			putJob(jobRing, MsgOperation.NONE, "", 0, [])
 
-		for i in range(self.workerCount):
-			con, _ = self.cons[i]
-			process = self.processes[i]
-			con.recv()
-			process.kill()
+		for process, (jobRing, resultRing) in zip(self.processes, self.rings):
+			getResults(resultRing)
+			process.join(1)
+			if process.is_alive():
+				process.kill()
+			jobRing.close(True)
+			resultRing.close(True)
 
 		self.processes = None
-		self.cons = None
-
-	def clearMessages(self, id: int = -1):
-		with suppress_stdout():
-			for dev in self.getDevices(id):
-				self.readMessage(dev, True)
-				dev.device.finalize()
+		self.rings = None
 
 	def processRequests(self, operation: MsgOperation, actionCount: int, data: str = "", count: int = 0):
 		messages: List[UnpackedMsg] = []
+		deviceLoads = self.getDeviceLoads(actionCount)
+		deviceLoads += [0] * (self.getCount() - len(deviceLoads))
 
 		# send request to process
-		for i in range(min(self.workerCount, actionCount)):
-			_, sendCon = self.cons[i]
-			process = self.processes[i]
-			ps = psutil.Process(process.pid)
-			ps.resume()
-			sendCon.send((operation, data, count))
+		busyWorkers = []
+		for i in range(self.workerCount):
+			loadCounts = [deviceLoads[index] for index in self.getShard(i)]
+			if any(loadCounts):
+				jobRing, _ = self.rings[i]
+				putJob(jobRing, operation, data, count, loadCounts)
+				busyWorkers.append(i)
 
 		# gather answers
-		for i in range(min(self.workerCount, actionCount)):
-			con, _ = self.cons[i]
-			process = self.processes[i]
-			messages.append(con.recv())
-			ps = psutil.Process(process.pid)
-			ps.suspend()
+		for i in busyWorkers:
+			_, resultRing = self.rings[i]
+			messages += getResults(resultRing)
+			self.computeTimes += getTimes(resultRing)
+			self.addWorkerCounts(getCounts(resultRing))
 
 		return messages
 
-	def handleProcess(self, index: int, sendCon: Connection, statusCon: Connection):
-		device: USB_Device = USB_Device(index, GetDevice(index))
+	def processLoadQueue(self, operation: MsgOperation, loadCount: int, data: str = "", count: int = 0) -> Tuple[List[UnpackedMsg], List[float]]:
+		self.loadQueue.reset(loadCount)
+		for jobRing, _ in self.rings:
+			putJob(jobRing, operation, data, count, [], True)
+
+		answers, times = [], []
+		for _, resultRing in self.rings:
+			answers += getResults(resultRing)
+			times += getTimes(resultRing)
+			self.computeTimes += getTimes(resultRing)
+			self.addWorkerCounts(getCounts(resultRing))
+		return answers, times
+
+	def addWorkerCounts(self, counts: List[int]):
+		self.workerCounts = [total + count for total, count in zip(self.workerCounts, counts)]
+
+	def takeTransferCounts(self) -> Tuple[int, int]:
+		# the devices are only used by the workers, their counters never change in this process
+		transfers, allocations, timeouts = self.workerCounts
+		self.workerCounts = [0, 0, timeouts]
+		return transfers, allocations
+
+	def takeTimeoutCount(self) -> int:
+		timeouts = self.workerCounts[2]
+		self.workerCounts[2] = 0
+		return timeouts
+
+	def getShard(self, workerIndex: int) -> List[int]:
+		# devices are dealt round robin, like the loads, so every worker gets its share of small requests
+		return list(range(workerIndex, self.getCount(), self.workerCount))
+
+	def handleProcess(self, workerIndex: int, jobRing: SharedRing, resultRing: SharedRing):
+		devices = [self.getWorkerDevice(index) for index in self.getShard(workerIndex)]
 		SetHostCores()
-		sendCon.send(None)
+		putResults(resultRing, [])
 
 		while True:
-			operation, data, count = statusCon.recv()
+			operation, data, count, loadCounts, queued = getJob(jobRing)
 			if operation == MsgOperation.NONE:
-				self.sendSingleMessage(device, MsgAction.STOP, operation)
-				sendCon.send(None)
+				for device in devices:
+					self.sendSingleMessage(device, MsgAction.STOP, operation)
+					device.transport.finalize()
+				putResults(resultRing, [])
+				return
+			elif queued:
+				answers, times = self.processShardQueue(devices, operation, data, count)
+				putResults(resultRing, answers)
+				putTimes(resultRing, times)
 			else:
-				answer = self.processSingleRequest(index, operation, data, count, device)
-				sendCon.send(answer)
+				putResults(resultRing, self.processShard(devices, operation, data, count, loadCounts))
+			# the worker's calculations and counters are handed to the host with every job, so they are counted once
+			putTimes(resultRing, self.waitForCompute())
+			putCounts(resultRing, takeDeviceCounts(devices))
 
-	def processSingleRequest(self, index: int, operation: MsgOperation, data: str, count: int, device: USB_Device):
-		# do time intensive calculations on the host
-		dataLen = int(data)
-		if dataLen > 0:
-			unpackedMsg = self.sendSingleMessage(device, MsgAction.CALCULATE, operation, dataLen, data)
-		else:
-			unpackedMsg = UnpackedMsg._make([True, True, -1, -1, -1, -1, ""])
+	def processShard(self, devices: List[USB_Device], operation: MsgOperation, data: str, count: int, loadCounts: List[int]) -> List[UnpackedMsg]:
+		answers = []
+		for device, loadCount in zip(devices, loadCounts):
+			if loadCount:
+				answers += self.processSingleRequest(device.id, operation, data, count, device, loadCount)
+		return answers
 
-		if operation == MsgOperation.TESTLOAD:
-			calculate(count)
+	def processShardQueue(self, devices: List[USB_Device], operation: MsgOperation, data: str, count: int) -> Tuple[List[UnpackedMsg], List[float]]:
+		return mergeQueuedResults(self.processQueuedLoads(device, operation, data, count) for device in devices)
+
+	def getWorkerDevice(self, index: int) -> USB_Device:
+		# local transports are inherited, the registry of a worker finds its USB devices again by bus and address
+		if self.transportType != TransportType.USB:
+			return self.devices[index]
+		key = DEVICE_REGISTRY.getKeys()[index]
+		return USB_Device(index, DEVICE_REGISTRY.getDevice(key), key, useLibusb=self.useLibusb)
 
-		device.device.finalize()
-		return unpackedMsg
+	def processSingleRequest(self, index: int, operation: MsgOperation, data: str, count: int, device: USB_Device, loadCount: int = 1):
+		return self.processDeviceLoads(device, operation, data, count, loadCount)
 
 	def requestClientAction(self, operation: MsgOperation, maxDevices: int = -1, data: str = "", count: int = 0):
 		actionCount = maxDevices if maxDevices >= 0 else self.getCount()
 		return self.processRequests(operation, actionCount, data, count)
+
+
+class USB_Host_Hybrid(USB_Host_Multiprocessing, USB_Host_Asyncio):
+	"""Splits the devices over a few worker processes, each one drives its shard concurrently with an event loop."""
+
+	def __init__(self, count, *args, processCount: int = PROCESS_COUNT, **kwargs):
+		super().__init__(count, *args, **kwargs)
+		self.workerCount = max(1, min(processCount, count))
+		self.loop: asyncio.AbstractEventLoop = None
+
+	def processShard(self, devices: List[USB_Device], operation: MsgOperation, data: str, count: int, loadCounts: List[int]) -> List[UnpackedMsg]:
+		# every worker process keeps its own loop
+		if not self.loop:
+			self.loop = asyncio.new_event_loop()
+			asyncio.set_event_loop(self.loop)
+		return self.loop.run_until_complete(self.processShardAsync(devices, operation, data, count, loadCounts))
+
+	async def processShardAsync(self, devices: List[USB_Device], operation: MsgOperation, data: str, count: int, loadCounts: List[int]) -> List[UnpackedMsg]:
+		tasks = [
+			self.processDeviceLoadsAsync(device, operation, data, count, loadCount)
+			for device, loadCount in zip(devices, loadCounts) if loadCount
+		]
+		return [answer for answers in await asyncio.gather(*tasks) for answer in answers]
+
+	def processShardQueue(self, devices: List[USB_Device], operation: MsgOperation, data: str, count: int) -> Tuple[List[UnpackedMsg], List[float]]:
+		if not self.loop:
+			self.loop = asyncio.new_event_loop()
+			asyncio.set_event_loop(self.loop)
+		return self.loop.run_until_complete(self.processLoadQueueAsync(devices, operation, data, count))
+
+
+class USB_Host_Actor(USB_Host_Threading):
+	"""
+	Every device gets an actor that owns its transfers: answers are read as soon as they arrive and handed to
+	the waiting request, the device's worker thread only queues writes and waits for its futures.
+	"""
+
+	def __init__(self, count, *args, **kwargs):
+		super().__init__(count, *args, **kwargs)
+		self.actors: Dict[USB_Device, DeviceActor] = {}
+
+	def prepareDevices(self):
+		super().prepareDevices()
+		for dev in self.getDevices(-1):
+			self.getActor(dev)
+
+	def getActor(self, dev: USB_Device) -> DeviceActor:
+		if dev not in self.actors:
+			self.actors[dev] = DeviceActor(dev, self.protocol, MAX_FRAME_SIZE)
+		return self.actors[dev]
+
+	def removeDevice(self, dev: USB_Device):
+		if (actor := self.actors.pop(dev, None)):
+			actor.close()
+		super().removeDevice(dev)
+
+	def writeMessage(self, dev: USB_Device, pack: Union[str, bytes]):
+		self.getActor(dev).write(pack)
+		dev.consumeCredits(len(pack))
+
+	def readMessage(
+		self,
+		dev: USB_Device,
+		skipAll: bool = False,
+		wantedAction: MsgAction = None,
+		echoSize: int = 8,
+		minSize: int = 0,
+		wantedIds: Container[int] = None,
+		timeout: int = None) -> UnpackedMsg:
+
+		actor = self.getActor(dev)
+		if skipAll:
+			actor.clear()
+			return
+		if timeout is None:
+			timeout = dev.getTimeout(echoSize + minSize)
+		future = actor.expect(wantedAction, wantedIds)
+		try:
+			return future.result(timeout / 1000)
+		except Exception as e:
+			actor.cancel(future)
+			if isinstance(e, FutureTimeoutError):
+				dev.timeouts += 1
+			print("Timeout", e)
+
+	def close(self):
+		# the actors stop before their transports are closed, all of them at once
+		for actor in self.actors.values():
+			actor.stop()
+		for actor in self.actors.values():
+			actor.close()
+		self.actors = {}
+		super().close()
+
+
+def takeDeviceCounts(devices: List[USB_Device]) -> List[int]:
+	"""Returns the IN transfers, receive buffer allocations and timed out reads of the devices since the last call."""
+	transfers, allocations, timeouts = 0, 0, 0
+	for dev in devices:
+		deviceTransfers, deviceAllocations = dev.transport.takeCounts()
+		transfers += deviceTransfers
+		allocations += deviceAllocations
+		timeouts += dev.timeouts
+		dev.timeouts = 0
+	return [transfers, allocations, timeouts]
+
+
+def getLoadTimes(answers: List[UnpackedMsg]) -> List[float]:
+	"""Returns how long every answered load took, from the start of its own request, so retry backoff and handshakes don't count."""
+	return [answer.rtt for answer in answers if answer and answer.rtt is not None]
+
+
+def mergeQueuedResults(deviceResults: Iterator[Tuple[List[UnpackedMsg], List[float]]]) -> Tuple[List[UnpackedMsg], List[float]]:
+	answers, times = [], []
+	for deviceAnswers, deviceTimes in deviceResults:
+		answers += deviceAnswers
+		times += deviceTimes
+	return answers, times
@@ -0,0 +1,296 @@
+import __init__
+import os
+import array
+import asyncio
+import atexit
+import ctypes
+import ctypes.util
+import threading
+import usb.core as usbcore
+from ctypes import byref, c_int, c_uint, c_ubyte, c_uint8, c_void_p, POINTER
+from typing import Callable, Dict, Tuple, Union
+
+from core.usb_util import CONFIGURATION_ID
+
+LIBUSB_ERROR_TIMEOUT = -7
+LIBUSB_TRANSFER_TYPE_BULK = 2
+
+# libusb_transfer_status
+TRANSFER_COMPLETED = 0
+TRANSFER_ERROR = 1
+TRANSFER_TIMED_OUT = 2
+TRANSFER_CANCELLED = 3
+
+# how long the event thread waits for completions before checking if it should stop (in microseconds)
+EVENT_TIMEOUT = 100000
+
+
+class LibUSB_Transfer(ctypes.Structure):
+	pass
+
+
+TransferCallback = ctypes.CFUNCTYPE(None, POINTER(LibUSB_Transfer))
+
+LibUSB_Transfer._fields_ = [
+	("dev_handle", c_void_p),
+	("flags", c_uint8),
+	("endpoint", c_ubyte),
+	("type", c_ubyte),
+	("timeout", c_uint),
+	("status", c_int),
+	("length", c_int),
+	("actual_length", c_int),
+	("callback", TransferCallback),
+	("user_data", c_void_p),
+	("buffer", POINTER(c_ubyte)),
+	("num_iso_packets", c_int),
+]
+
+
+class TimeVal(ctypes.Structure):
+	_fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long)]
+
+
+def loadLibrary():
+	path = ctypes.util.find_library("usb-1.0")
+	if not path:
+		return None
+	lib = ctypes.CDLL(path)
+
+	lib.libusb_init.argtypes = [POINTER(c_void_p)]
+	lib.libusb_exit.argtypes = [c_void_p]
+	lib.libusb_exit.restype = None
+	lib.libusb_error_name.argtypes = [c_int]
+	lib.libusb_error_name.restype = ctypes.c_char_p
+	lib.libusb_get_device_list.argtypes = [c_void_p, POINTER(POINTER(c_void_p))]
+	lib.libusb_get_device_list.restype = ctypes.c_ssize_t
+	lib.libusb_free_device_list.argtypes = [POINTER(c_void_p), c_int]
+	lib.libusb_free_device_list.restype = None
+	lib.libusb_get_bus_number.argtypes = [c_void_p]
+	lib.libusb_get_bus_number.restype = c_uint8
+	lib.libusb_get_device_address.argtypes = [c_void_p]
+	lib.libusb_get_device_address.restype = c_uint8
+	lib.libusb_open.argtypes = [c_void_p, POINTER(c_void_p)]
+	lib.libusb_close.argtypes = [c_void_p]
+	lib.libusb_close.restype = None
+	lib.libusb_set_auto_detach_kernel_driver.argtypes = [c_void_p, c_int]
+	lib.libusb_claim_interface.argtypes = [c_void_p, c_int]
+	lib.libusb_release_interface.argtypes = [c_void_p, c_int]
+	lib.libusb_bulk_transfer.argtypes = [c_void_p, c_ubyte, POINTER(c_ubyte), c_int, POINTER(c_int), c_uint]
+	lib.libusb_alloc_transfer.argtypes = [c_int]
+	lib.libusb_alloc_transfer.restype = POINTER(LibUSB_Transfer)
+	lib.libusb_free_transfer.argtypes = [POINTER(LibUSB_Transfer)]
+	lib.libusb_free_transfer.restype = None
+	lib.libusb_submit_transfer.argtypes = [POINTER(LibUSB_Transfer)]
+	lib.libusb_cancel_transfer.argtypes = [POINTER(LibUSB_Transfer)]
+	lib.libusb_handle_events_timeout_completed.argtypes = [c_void_p, POINTER(TimeVal), POINTER(c_int)]
+	return lib
+
+
+LIB = loadLibrary()
+LIBUSB_AVAILABLE = LIB is not None
+
+
+def check(result: int) -> int:
+	# raise the same errors as pyusb, so the host handles both backends alike
+	if result < 0:
+		message = LIB.libusb_error_name(result).decode("utf-8")
+		if result == LIBUSB_ERROR_TIMEOUT:
+			raise usbcore.USBTimeoutError(message, result, result)
+		raise usbcore.USBError(message, result, result)
+	return result
+
+
+class LibUSB_Context:
+	"""A libusb context whose transfer completions are all handled by a single event thread."""
+
+	def __init__(self):
+		self.ctx = c_void_p()
+		check(LIB.libusb_init(byref(self.ctx)))
+		self.handles: Dict[Tuple[int, int], c_void_p] = {}
+		# submitted transfers together with their buffer and callback, so they aren't collected too early
+		self.pending: Dict[int, Tuple[POINTER(LibUSB_Transfer), ctypes.Array, Callable]] = {}
+		self.lock = threading.Lock()
+		self.running = False
+		self.eventThread: threading.Thread = None
+		self.onTransferDone = TransferCallback(self.handleTransferDone)
+
+	def open(self, bus: int, address: int, interface: int = CONFIGURATION_ID) -> c_void_p:
+		if (bus, address) in self.handles:
+			return self.handles[(bus, address)]
+
+		deviceList = POINTER(c_void_p)()
+		count = check(LIB.libusb_get_device_list(self.ctx, byref(deviceList)))
+		handle = None
+		try:
+			for i in range(count):
+				device = deviceList[i]
+				if LIB.libusb_get_bus_number(device) == bus and LIB.libusb_get_device_address(device) == address:
+					handle = c_void_p()
+					check(LIB.libusb_open(device, byref(handle)))
+					break
+		finally:
+			LIB.libusb_free_device_list(deviceList, 1)
+		if handle is None:
+			raise usbcore.USBError("Device %s:%s not found" % (bus, address))
+
+		LIB.libusb_set_auto_detach_kernel_driver(handle, 1)
+		check(LIB.libusb_claim_interface(handle, interface))
+		self.handles[(bus, address)] = handle
+		return handle
+
+	def submit(self, handle: c_void_p, endpoint: int, buffer: ctypes.Array, callback: Callable[[int, bytes], None], timeout: int = 0):
+		transfer = LIB.libusb_alloc_transfer(0)
+		if not transfer:
+			raise usbcore.USBError("Transfer could not be allocated")
+		t = transfer.contents
+		t.dev_handle = handle
+		t.endpoint = endpoint
+		t.type = LIBUSB_TRANSFER_TYPE_BULK
+		t.timeout = timeout
+		t.length = len(buffer)
+		t.callback = self.onTransferDone
+		t.buffer = ctypes.cast(buffer, POINTER(c_ubyte))
+
+		with self.lock:
+			self.pending[ctypes.addressof(t)] = (transfer, buffer, callback)
+		result = LIB.libusb_submit_transfer(transfer)
+		if result < 0:
+			with self.lock:
+				del self.pending[ctypes.addressof(t)]
+			LIB.libusb_free_transfer(transfer)
+			check(result)
+		self.startEvents()
+
+	def handleTransferDone(self, transferPointer):
+		t = transferPointer.contents
+		with self.lock:
+			transfer, buffer, callback = self.pending.pop(ctypes.addressof(t))
+		status = t.status
+		data = ctypes.string_at(buffer, t.actual_length)
+		LIB.libusb_free_transfer(transfer)
+		callback(status, data)
+
+	def startEvents(self):
+		if self.running:
+			return
+		self.running = True
+		self.eventThread = threading.Thread(target=self.handleEvents, daemon=True)
+		self.eventThread.start()
+
+	def handleEvents(self):
+		timeout = TimeVal(0, EVENT_TIMEOUT)
+		# keep going until cancelled transfers have called back
+		while self.running or self.pending:
+			LIB.libusb_handle_events_timeout_completed(self.ctx, byref(timeout), None)
+
+	def close(self):
+		with self.lock:
+			transfers = [transfer for transfer, _, _ in self.pending.values()]
+		for transfer in transfers:
+			LIB.libusb_cancel_transfer(transfer)
+		self.running = False
+		if self.eventThread:
+			self.eventThread.join()
+		for handle in self.handles.values():
+			LIB.libusb_release_interface(handle, CONFIGURATION_ID)
+			LIB.libusb_close(handle)
+		self.handles = {}
+		LIB.libusb_exit(self.ctx)
+
+
+class LibUSB_Endpoint:
+	"""Bulk endpoint with the read and write calls of a pyusb endpoint and additional asynchronous transfers."""
+
+	def __init__(self, context: LibUSB_Context, handle: c_void_p, address: int, maxPacketSize: int):
+		self.context = context
+		self.handle = handle
+		self.bEndpointAddress = address
+		self.wMaxPacketSize = maxPacketSize
+
+	def write(self, data: Union[str, bytes], timeout: int = 1000) -> int:
+		if isinstance(data, str):
+			data = data.encode("utf-8")
+		buffer = (c_ubyte * len(data)).from_buffer_copy(data)
+		transferred = c_int()
+		check(LIB.libusb_bulk_transfer(self.handle, self.bEndpointAddress, buffer, len(data), byref(transferred), timeout))
+		return transferred.value
+
+	def read(self, sizeOrBuffer: Union[int, array.array], timeout: int = 1000) -> Union[bytes, int]:
+		# like pyusb, a given array is filled and the number of received bytes returned
+		if isinstance(sizeOrBuffer, array.array):
+			buffer = (c_ubyte * len(sizeOrBuffer)).from_buffer(sizeOrBuffer)
+		else:
+			buffer = (c_ubyte * sizeOrBuffer)()
+		transferred = c_int()
+		check(LIB.libusb_bulk_transfer(self.handle, self.bEndpointAddress, buffer, len(buffer), byref(transferred), timeout))
+		if isinstance(sizeOrBuffer, array.array):
+			return transferred.value
+		return ctypes.string_at(buffer, transferred.value)
+
+	def submitWrite(self, data: Union[str, bytes], callback: Callable[[int, bytes], None], timeout: int = 1000):
+		if isinstance(data, str):
+			data = data.encode("utf-8")
+		self.context.submit(self.handle, self.bEndpointAddress, (c_ubyte * len(data)).from_buffer_copy(data), callback, timeout)
+
+	def submitRead(self, size: int, callback: Callable[[int, bytes], None], timeout: int = 1000):
+		self.context.submit(self.handle, self.bEndpointAddress, (c_ubyte * size)(), callback, timeout)
+
+	def writeAsync(self, data: Union[str, bytes], timeout: int = 1000) -> asyncio.Future:
+		future = asyncio.get_event_loop().create_future()
+		self.submitWrite(data, self.getFutureCallback(future), timeout)
+		return future
+
+	def readAsync(self, size: int, timeout: int = 1000) -> asyncio.Future:
+		future = asyncio.get_event_loop().create_future()
+		self.submitRead(size, self.getFutureCallback(future), timeout)
+		return future
+
+	def getFutureCallback(self, future: asyncio.Future) -> Callable[[int, bytes], None]:
+		loop = future.get_loop()
+
+		def setResult(status: int, data: bytes):
+			if future.done():
+				return
+			if status == TRANSFER_COMPLETED:
+				future.set_result(data)
+			elif status == TRANSFER_TIMED_OUT:
+				future.set_exception(usbcore.USBTimeoutError("Timeout", LIBUSB_ERROR_TIMEOUT, LIBUSB_ERROR_TIMEOUT))
+			else:
+				future.set_exception(usbcore.USBError("Transfer failed with status %s" % status))
+
+		# the callback runs on the event thread
+		return lambda status, data: loop.call_soon_threadsafe(setResult, status, data)
+
+
+context: LibUSB_Context = None
+contextPid: int = None
+
+
+def GetContext() -> LibUSB_Context:
+	# libusb contexts don't survive a fork, so every process gets its own
+	global context, contextPid
+	if context is None or contextPid != os.getpid():
+		context = LibUSB_Context()
+		contextPid = os.getpid()
+	return context
+
+
+def OpenEndpoints(bus: int, address: int, outEp: usbcore.Endpoint, inEp: usbcore.Endpoint) -> Tuple[LibUSB_Endpoint, LibUSB_Endpoint]:
+	"""Opens the device with libusb and replaces the given pyusb endpoints."""
+	ctx = GetContext()
+	handle = ctx.open(bus, address)
+	return (
+		LibUSB_Endpoint(ctx, handle, outEp.bEndpointAddress, outEp.wMaxPacketSize),
+		LibUSB_Endpoint(ctx, handle, inEp.bEndpointAddress, inEp.wMaxPacketSize),
+	)
+
+
+def CloseContext():
+	global context
+	if context is not None and contextPid == os.getpid():
+		context.close()
+		context = None
+
+
+atexit.register(CloseContext)
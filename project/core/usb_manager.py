@@ -1,11 +1,14 @@
 import os
 import __init__
+import subprocess
 from typing import Any, List, Union
 import time
 from util import suppress_stdout
 from setup.create_devices import getActiveDeciveCount, getGadgetPath, getMaxDeviceCount
 from core.usb_util import MsgOperation, MsgAction, MsgSender, USE_ACM, CommunicationType, MsgStatus, GetDeviceCount
-from core.usb_host import USB_Host, USB_Host_Asyncio, USB_Host_Multiprocessing, USB_Host_Threading
+from core.usb_util import ProtocolType, PROTOCOL_TYPE, USE_TTY_ECHO, toBytes, TransportType, TRANSPORT_TYPE
+from core.usb_transport import LOCAL_DEVICE_COUNT
+from core.usb_host import USB_Host, USB_Host_Asyncio, USB_Host_Multiprocessing, USB_Host_Threading, USB_Host_Hybrid, USB_Host_Actor
 from core.usb_client import USB_Client
 from eval.usb_testload import TestLoad
 from core.resource_manager import SetHostCores
@@ -51,30 +54,38 @@ def main():
 
 def ProcessTestLoad(host: USB_Host, load: TestLoad, loadCount: int, repeats: int = 1):
 	for _ in range(repeats):
+		host.takeTransferCounts()
+		host.takeTimeoutCount()
 		load.startMeasure()
-		maxCount = host.getCount()
-		curCount = 0
-		answers = []
-		while curCount < loadCount:
-			nextCount = min(loadCount - curCount, maxCount)
-			newAnswers = host.requestClientAction(MsgOperation.TESTLOAD, nextCount, str(load.dataLen), load.count)
-			if not newAnswers:
-				return
-			answers += newAnswers
-			curCount += nextCount
+		# every device takes its next loads as soon as it is done, so slow devices don't hold back the others
+		answers, loadTimes = host.processLoadQueue(MsgOperation.TESTLOAD, loadCount, str(load.dataLen), load.count)
+		computeTimes = host.waitForCompute()
 		load.stopMeasure()
+		load.addLoadTimes(loadTimes)
+		load.addComputeTimes(computeTimes)
+		load.addTransferCounts(*host.takeTransferCounts())
+		load.addTimeouts(host.takeTimeoutCount())
+		savedEchoSize = host.getSavedEchoSize(MsgAction.CALCULATE, MsgOperation.TESTLOAD, str(load.dataLen))
 		for i, answer in enumerate(answers):
 			if answer:
+				load.addTransferSize(answer.dataSize, answer.wireSize, savedEchoSize)
 				try:
-					load.checkResult(answer.data, True)
+					if answer.checksum is None:
+						load.checkResult(answer.data, True)
+					else:
+						load.checkChecksum(answer.checksum, answer.dataSize)
 				except Exception as e:
 					load.addFailedTry()
 			else:
 				load.addFailedTry()
+		# loads no device took, because all of them were out of rotation
+		for _ in range(loadCount - len(answers)):
+			load.addFailedTry()
 
 
 def StartClientCalculation(host: USB_Host, operation: MsgOperation, data: str, clientID: int = -1) -> Union[None, str]:
 	answer = host.requestClientAction(operation, clientID, data)
+	host.waitForCompute()
 	if not answer:
 		return
 	if clientID >= 0:
@@ -108,7 +119,7 @@ def TestClientCalculation() -> bool:
 	host = GetAndActivateHost()
 
 	answers = StartClientCalculation(host, MsgOperation.MULTIPLY, "500")
-	answerCount = sum(map(lambda c: 1 if c == "1000" else 0, answers))
+	answerCount = sum(map(lambda c: 1 if toBytes(c) == b"1000" else 0, answers))
 
 	print("%s Calculations successfull!" % answerCount)
 
@@ -117,36 +128,54 @@ def TestClientCalculation() -> bool:
 	return answerCount == host.getCount()
 
 
-def MakeClients(count: int) -> List[USB_Client]:
+def MakeClients(
+	count: int,
+	protocol: ProtocolType = PROTOCOL_TYPE,
+	echo: bool = USE_TTY_ECHO,
+	deviceFiles: List[Union[str, int]] = None) -> List[USB_Client]:
+
 	clients = []
 	for i in range(count):
-		client = USB_Client(i)
+		client = USB_Client(i, protocol, echo, deviceFiles[i] if deviceFiles else None)
 		clients.append(client)
 	return clients
 
 
-def MakeSingleClients(count: int):
-	command = ""
+def MakeSingleClients(count: int, protocol: ProtocolType = PROTOCOL_TYPE, echo: bool = USE_TTY_ECHO, deviceFiles: List[Union[str, int]] = None):
+	path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "usb_single_client.py")
 	for index in range(count):
-		path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "usb_single_client.py")
-		command += "python3.8 %s %s &" % (path, index)
-	os.system(command)
+		args = ["python3.8", path, str(index), protocol.value, str(int(echo))]
+		deviceFile = deviceFiles[index] if deviceFiles else None
+		if deviceFile is not None:
+			args.append(str(deviceFile))
+		# open file descriptors (socketpairs) have to be passed on to the client process
+		subprocess.Popen(args, pass_fds=[deviceFile] if isinstance(deviceFile, int) else [])
+
 
+def GetAndActivateHost(
+	comType: CommunicationType = CommunicationType.BASIC,
+	protocol: ProtocolType = PROTOCOL_TYPE,
+	transportType: TransportType = TRANSPORT_TYPE) -> USB_Host:
 
-def GetAndActivateHost(comType: CommunicationType = CommunicationType.BASIC) -> USB_Host:
 	SetHostCores()
-	count = getActiveDeciveCount()
+	count = getActiveDeciveCount() if transportType == TransportType.USB else LOCAL_DEVICE_COUNT
 
 	if comType == comType.THREADING:
-		host = USB_Host_Threading(count)
+		host = USB_Host_Threading(count, protocol, transportType=transportType)
 	elif comType == comType.MULTIPROCESSING:
-		host = USB_Host_Multiprocessing(count)
+		host = USB_Host_Multiprocessing(count, protocol, transportType=transportType)
+	elif comType == comType.HYBRID:
+		host = USB_Host_Hybrid(count, protocol, transportType=transportType)
 	elif comType == comType.ASYNCIO:
-		host = USB_Host_Asyncio(count)
+		host = USB_Host_Asyncio(count, protocol, transportType=transportType)
+	elif comType == comType.ACTOR:
+		host = USB_Host_Actor(count, protocol, transportType=transportType)
 	else:
-		host = USB_Host(count)
+		host = USB_Host(count, protocol, transportType=transportType)
 
-	MakeSingleClients(count)
+	# the gadgets' ttys are found by the clients themselves, local transports hand theirs over
+	deviceFiles = host.getClientFiles() if transportType != TransportType.USB else None
+	MakeSingleClients(count, protocol, host.echo, deviceFiles)
 
 	return host
 
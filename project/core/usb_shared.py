@@ -0,0 +1,182 @@
+import __init__
+import struct
+from multiprocessing import Semaphore
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Tuple, Union
+
+from core.usb_util import MsgOperation, UnpackedMsg
+
+# how many bytes fit into each ring between the host and one of its worker processes?
+RING_SIZE = 1 << 20
+
+# total bytes written to and read from a ring, they only ever grow
+RING_HEAD = struct.Struct("<Q")
+RING_TAIL = struct.Struct("<Q")
+RING_HEADER_SIZE = RING_HEAD.size + RING_TAIL.size
+RECORD_SIZE = struct.Struct("<I")
+
+# operation, count, queued, number of devices (followed by the load count of every device and the data)
+JOB = struct.Struct("<bI?H")
+LOAD_COUNT = struct.Struct("<I")
+# flags, sender, status, action, operation, requestId, compression, wireSize, checksum, dataSize, sequence, credits, length
+RESULT = struct.Struct("<BbbbbIBIIIIII")
+
+RESULT_PRESENT = 0x01
+RESULT_START = 0x02
+RESULT_END = 0x04
+RESULT_STREAM = 0x08
+RESULT_TEXT = 0x10
+RESULT_CHECKSUM = 0x20
+
+
+class SharedRing:
+	"""Byte ring in shared memory for exactly one writing and one reading process, records are length prefixed."""
+
+	def __init__(self, size: int = RING_SIZE):
+		self.size = size
+		self.memory = SharedMemory(create=True, size=RING_HEADER_SIZE + size)
+		RING_HEAD.pack_into(self.memory.buf, 0, 0)
+		RING_TAIL.pack_into(self.memory.buf, RING_HEAD.size, 0)
+		# counts the records that can be read and wakes up writers waiting for space
+		self.items = Semaphore(0)
+		self.freed = Semaphore(0)
+
+	def put(self, *parts: Union[bytes, memoryview]):
+		length = sum(len(part) for part in parts)
+		needed = RECORD_SIZE.size + length
+		if needed > self.size:
+			raise ValueError("A record of %s bytes does not fit into the ring" % length)
+
+		head = RING_HEAD.unpack_from(self.memory.buf, 0)[0]
+		while self.size - (head - RING_TAIL.unpack_from(self.memory.buf, RING_HEAD.size)[0]) < needed:
+			self.freed.acquire()
+
+		pos = self.write(head, RECORD_SIZE.pack(length))
+		for part in parts:
+			pos = self.write(pos, part)
+		RING_HEAD.pack_into(self.memory.buf, 0, pos)
+		self.items.release()
+
+	def get(self) -> bytes:
+		self.items.acquire()
+		tail = RING_TAIL.unpack_from(self.memory.buf, RING_HEAD.size)[0]
+		length = RECORD_SIZE.unpack(self.read(tail, RECORD_SIZE.size))[0]
+		record = self.read(tail + RECORD_SIZE.size, length)
+		RING_TAIL.pack_into(self.memory.buf, RING_HEAD.size, tail + RECORD_SIZE.size + length)
+		self.freed.release()
+		return record
+
+	def write(self, pos: int, data: Union[bytes, memoryview]) -> int:
+		start = pos % self.size
+		first = min(len(data), self.size - start)
+		self.memory.buf[RING_HEADER_SIZE + start:RING_HEADER_SIZE + start + first] = data[:first]
+		if first < len(data):
+			self.memory.buf[RING_HEADER_SIZE:RING_HEADER_SIZE + len(data) - first] = data[first:]
+		return pos + len(data)
+
+	def read(self, pos: int, length: int) -> bytes:
+		start = pos % self.size
+		first = min(length, self.size - start)
+		data = bytes(self.memory.buf[RING_HEADER_SIZE + start:RING_HEADER_SIZE + start + first])
+		if first < length:
+			data += bytes(self.memory.buf[RING_HEADER_SIZE:RING_HEADER_SIZE + length - first])
+		return data
+
+	def close(self, unlink: bool = False):
+		self.memory.close()
+		if unlink:
+			self.memory.unlink()
+
+
+def putJob(ring: SharedRing, operation: MsgOperation, data: str, count: int, loadCounts: List[int], queued: bool = False):
+	# queued jobs take their loads from the host's load queue instead
+	loads = struct.pack("<%sI" % len(loadCounts), *loadCounts)
+	ring.put(JOB.pack(operation.value, count or 0, queued, len(loadCounts)), loads, (data or "").encode("utf-8"))
+
+
+def getJob(ring: SharedRing) -> Tuple[MsgOperation, str, int, List[int], bool]:
+	record = ring.get()
+	operation, count, queued, deviceCount = JOB.unpack_from(record)
+	dataStart = JOB.size + deviceCount * LOAD_COUNT.size
+	loadCounts = list(struct.unpack_from("<%sI" % deviceCount, record, JOB.size))
+	return MsgOperation(operation), record[dataStart:].decode("utf-8"), count, loadCounts, queued
+
+
+def putResults(ring: SharedRing, results: List[UnpackedMsg]):
+	ring.put(RECORD_SIZE.pack(len(results)))
+	for result in results:
+		if not result:
+			ring.put(RESULT.pack(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0))
+			continue
+		data = result.data
+		flags = RESULT_PRESENT
+		flags |= RESULT_START if result.isStart else 0
+		flags |= RESULT_END if result.isEnd else 0
+		flags |= RESULT_STREAM if result.stream else 0
+		flags |= RESULT_CHECKSUM if result.checksum is not None else 0
+		if isinstance(data, str):
+			flags |= RESULT_TEXT
+			data = data.encode("utf-8")
+		# the payload is copied straight into the ring, behind its header
+		ring.put(RESULT.pack(
+			flags,
+			result.sender,
+			result.status,
+			result.action,
+			result.operation,
+			result.requestId,
+			result.compression,
+			result.wireSize,
+			result.checksum or 0,
+			result.dataSize,
+			result.sequence,
+			result.credits,
+			len(data)
+		), data)
+
+
+def getResults(ring: SharedRing) -> List[UnpackedMsg]:
+	results: List[UnpackedMsg] = []
+	for _ in range(RECORD_SIZE.unpack(ring.get())[0]):
+		record = ring.get()
+		flags, sender, status, action, operation, requestId, compression, wireSize, checksum, dataSize, sequence, credits, length = RESULT.unpack_from(record)
+		if not flags & RESULT_PRESENT:
+			results.append(None)
+			continue
+		data = record[RESULT.size:RESULT.size + length]
+		results.append(UnpackedMsg(
+			bool(flags & RESULT_START),
+			bool(flags & RESULT_END),
+			sender,
+			status,
+			action,
+			operation,
+			data.decode("utf-8") if flags & RESULT_TEXT else data,
+			requestId,
+			compression,
+			wireSize,
+			checksum if flags & RESULT_CHECKSUM else None,
+			dataSize,
+			sequence,
+			bool(flags & RESULT_STREAM),
+			credits
+		))
+	return results
+
+
+def putTimes(ring: SharedRing, times: List[float]):
+	ring.put(struct.pack("<%sd" % len(times), *times))
+
+
+def getTimes(ring: SharedRing) -> List[float]:
+	record = ring.get()
+	return list(struct.unpack("<%sd" % (len(record) // 8), record))
+
+
+def putCounts(ring: SharedRing, counts: List[int]):
+	ring.put(struct.pack("<%sq" % len(counts), *counts))
+
+
+def getCounts(ring: SharedRing) -> List[int]:
+	record = ring.get()
+	return list(struct.unpack("<%sq" % (len(record) // 8), record))
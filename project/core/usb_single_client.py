@@ -1,105 +1,26 @@
 import __init__
-import os
-import io
 import sys
-from typing import Dict, List
-from core.usb_util import MsgAction, MsgOperation, MsgStatus, MsgSender, packMsg, unpackMsg, UnpackedMsg
+from core.usb_util import ProtocolType, PROTOCOL_TYPE, USE_TTY_ECHO
+from core.usb_client_protocol import USB_Client_Protocol
 from core.resource_manager import SetClientCores
 
 
-def chunks(arr: List, n):
-	n = max(1, n)
-	return list(arr[i: i + n] for i in range(0, len(arr), n))
+class USB_Client(USB_Client_Protocol):
+	"""Client in a process of its own, the manager starts one for every device."""
 
-
-class USB_Client():
-
-	def __init__(self, id: int):
-		super(USB_Client, self).__init__()
-		self.id = id
-		self.active = False
-		self.deviceFile = "/dev/ttyGS%s" % (self.id)
-
-	def activate(self):
-		if self.active:
-			print("Already active!")
-			return
-		self.active = True
+	def start(self):
+		# the process only serves its device, so it runs in the foreground
 		self.run()
 
-	def run(self):
-		try:
-			f = io.TextIOWrapper(io.FileIO(os.open(self.deviceFile, os.O_RDWR), "r+"))
-			for msg in iter(f.readline, None):
-				# print("Got msg", self.id)
-				unpackedMsg = unpackMsg(msg)
-				if not unpackedMsg:
-					continue
-
-				response = self.respond(unpackedMsg)
-				responseMsg = packMsg(MsgSender.CLIENT, response["status"], response["action"], response["operation"], response["data"])
-
-				# print("Send:", self.id, responseMsg)
-				for rMsg in chunks(responseMsg, 255):
-					f.write(rMsg)
-
-				# stop listening if stop command was send
-				if (response["action"] == MsgAction.STOP.value):
-					sys.exit()
-
-		except Exception as e:
-			pass
-			print("Receive Error:", e)
-		finally:
-			if "f" in locals():
-				f.close()
-
-	def respond(self, content: UnpackedMsg) -> Dict:
-		# print("Receive message: ", content)
-		response = {"status": MsgStatus.UNKNOWN, "action": int(content.action), "operation": int(content.operation), "data": ""}
-		action = int(content.action)
-
-		if action == MsgAction.STOP.value:
-			if self.active:
-				self.active = False
-				response["status"] = MsgStatus.OK
-			else:
-				response["status"] = MsgStatus.FAIL
-		elif action == MsgAction.PING.value:
-			response["status"] = MsgStatus.OK
-		elif action == MsgAction.CALCULATE.value:
-			response["status"], response["data"] = self.handleInput(content)
-
-		else:
-			pass
-			# print("Cannot respond [%s] to: " % self.id, action)
-		return response
-
-	def handleInput(self, content: UnpackedMsg) -> Dict:
-		status = MsgStatus.OK
-		data = ""
-		try:
-			if content.operation == MsgOperation.MULTIPLY.value:
-				input = int(content.data)
-				data = input * 2
-			elif content.operation == MsgOperation.AVERAGE.value:
-				# totalSum = sum(input)
-				# data = totalSum / len(input)
-				raise Exception
-			elif content.operation == MsgOperation.FINDX.value:
-				# data = input[1][input[0]]
-				raise Exception
-			elif content.operation == MsgOperation.TESTLOAD.value:
-				dataLen = int(content.data.strip())
-				data = "a" * dataLen
-		except Exception as e:
-			status = MsgStatus.FAIL
-			print(e)
-		return status, data
-
 
 if __name__ == "__main__":
 	SetClientCores()
 	index = sys.argv[1:][0]
-	client = USB_Client(index)
+	protocol = ProtocolType(sys.argv[2]) if len(sys.argv) > 2 else PROTOCOL_TYPE
+	echo = bool(int(sys.argv[3])) if len(sys.argv) > 3 else USE_TTY_ECHO
+	deviceFile = sys.argv[4] if len(sys.argv) > 4 else None
+	# inherited file descriptors are passed as numbers
+	if deviceFile and deviceFile.isdigit():
+		deviceFile = int(deviceFile)
+	client = USB_Client(index, protocol, echo, deviceFile)
 	client.activate()
@@ -0,0 +1,253 @@
+import __init__
+import os
+import abc
+import array
+import asyncio
+import pty
+import select
+import socket
+import tty
+import usb.core as usbcore
+from concurrent.futures import Executor
+from typing import Dict, List, Tuple, Union
+
+from core.usb_util import TransportType
+from core.usb_libusb import LibUSB_Endpoint
+
+# how many clients are simulated with the local transports
+LOCAL_DEVICE_COUNT = 8
+
+# local transports have no endpoints, they read in packets of a high speed bulk endpoint
+LOCAL_PACKET_SIZE = 512
+
+
+class ReceiveBufferPool:
+	"""Reusable receive buffers of whole packets, a buffer is only allocated if none of its size is free."""
+
+	def __init__(self, packetSize: int):
+		self.packetSize = packetSize
+		self.free: Dict[int, List[array.array]] = {}
+		self.allocations = 0
+
+	def getSize(self, size: int) -> int:
+		# a transfer that ends inside a packet would cut off the rest of it
+		return max(1, -(-size // self.packetSize)) * self.packetSize
+
+	def get(self, size: int) -> array.array:
+		size = self.getSize(size)
+		if self.free.get(size):
+			return self.free[size].pop()
+		self.allocations += 1
+		return array.array("B", bytes(size))
+
+	def put(self, buffer: array.array):
+		self.free.setdefault(len(buffer), []).append(buffer)
+
+
+class Transport(abc.ABC):
+	"""Host side of the byte stream to a single client."""
+
+	def __init__(self, packetSize: int = LOCAL_PACKET_SIZE):
+		self.receiveBuffers = ReceiveBufferPool(packetSize)
+		# IN transfers since the counters were taken last
+		self.transfers = 0
+		# runs the blocking transfers of the async methods, None is the default executor of the event loop
+		self.executor: Executor = None
+
+	@abc.abstractmethod
+	def write(self, data: Union[str, bytes]) -> int:
+		"""Sends all of data and returns how many bytes that were."""
+
+	@abc.abstractmethod
+	def readInto(self, buffer: array.array, timeout: int = 1000) -> int:
+		"""Fills the buffer with what arrives in time and returns how many bytes that were."""
+
+	def receive(self, size: int, timeout: int = 1000) -> memoryview:
+		"""
+		Reads at least size bytes worth of whole packets into a pooled buffer.
+		The returned view is only valid until the next receive on this transport.
+		"""
+		buffer = self.receiveBuffers.get(size)
+		try:
+			received = self.readInto(buffer, timeout)
+		finally:
+			self.receiveBuffers.put(buffer)
+		self.transfers += 1
+		return memoryview(buffer)[:received]
+
+	async def writeAsync(self, data: Union[str, bytes]) -> int:
+		# transports without asynchronous transfers block an executor thread instead
+		return await asyncio.get_event_loop().run_in_executor(self.executor, self.write, data)
+
+	async def receiveAsync(self, size: int, timeout: int = 1000) -> memoryview:
+		return await asyncio.get_event_loop().run_in_executor(self.executor, self.receive, size, timeout)
+
+	def hasAsyncTransfers(self) -> bool:
+		"""Whether the async methods wait for the transfers without blocking an executor thread."""
+		return False
+
+	def takeCounts(self) -> Tuple[int, int]:
+		"""Returns the IN transfers and receive buffer allocations since the last call."""
+		counts = (self.transfers, self.receiveBuffers.allocations)
+		self.transfers = 0
+		self.receiveBuffers.allocations = 0
+		return counts
+
+	@abc.abstractmethod
+	def getClientFile(self) -> Union[str, int]:
+		"""Returns what the client opens: a device path or an already open file descriptor."""
+
+	def finalize(self):
+		pass
+
+	def close(self):
+		pass
+
+
+class USB_Transport(Transport):
+
+	def __init__(self, id: int, device: usbcore.Device, outEp: usbcore.Endpoint, inEp: usbcore.Endpoint):
+		super().__init__(inEp.wMaxPacketSize)
+		self.id = id
+		self.device = device
+		self.outEp = outEp
+		self.inEp = inEp
+
+	def write(self, data: Union[str, bytes]) -> int:
+		return self.outEp.write(data)
+
+	def readInto(self, buffer: array.array, timeout: int = 1000) -> int:
+		# both pyusb and libusb endpoints fill a given array instead of allocating a new one
+		return self.inEp.read(buffer, timeout)
+
+	async def writeAsync(self, data: Union[str, bytes]) -> int:
+		if isinstance(self.outEp, LibUSB_Endpoint):
+			return len(await self.outEp.writeAsync(data))
+		return await super().writeAsync(data)
+
+	async def receiveAsync(self, size: int, timeout: int = 1000) -> memoryview:
+		if isinstance(self.inEp, LibUSB_Endpoint):
+			# completed libusb transfers are copied out of their own buffer anyway
+			self.transfers += 1
+			return memoryview(await self.inEp.readAsync(self.receiveBuffers.getSize(size), timeout))
+		return await super().receiveAsync(size, timeout)
+
+	def hasAsyncTransfers(self) -> bool:
+		return isinstance(self.inEp, LibUSB_Endpoint) and isinstance(self.outEp, LibUSB_Endpoint)
+
+	def getClientFile(self) -> str:
+		return "/dev/ttyGS%s" % self.id
+
+	def finalize(self):
+		self.device.finalize()
+
+	def close(self):
+		self.finalize()
+
+
+class File_Transport(Transport):
+	"""Transport over a local file descriptor pair, the client gets the other end."""
+
+	def __init__(self, fd: int, clientFd: int):
+		super().__init__()
+		self.fd = fd
+		self.clientFd = clientFd
+		# the host side never blocks, so the event loop of the asyncio host can wait for it
+		os.set_blocking(fd, False)
+
+	def write(self, data: Union[str, bytes]) -> int:
+		if isinstance(data, str):
+			data = data.encode("utf-8")
+		with memoryview(data) as view:
+			while view:
+				try:
+					view = view[os.write(self.fd, view):]
+				except BlockingIOError:
+					select.select([], [self.fd], [])
+		return len(data)
+
+	def readInto(self, buffer: array.array, timeout: int = 1000) -> int:
+		# behave like a bulk endpoint, which raises when nothing arrives in time
+		if not select.select([self.fd], [], [], timeout / 1000)[0]:
+			raise usbcore.USBTimeoutError("Operation timed out")
+		return os.readv(self.fd, [buffer])
+
+	async def writeAsync(self, data: Union[str, bytes]) -> int:
+		if isinstance(data, str):
+			data = data.encode("utf-8")
+		with memoryview(data) as view:
+			while view:
+				try:
+					view = view[os.write(self.fd, view):]
+				except BlockingIOError:
+					await self.waitUntilReady(True)
+		return len(data)
+
+	async def receiveAsync(self, size: int, timeout: int = 1000) -> memoryview:
+		try:
+			await asyncio.wait_for(self.waitUntilReady(), timeout / 1000)
+		except asyncio.TimeoutError:
+			raise usbcore.USBTimeoutError("Operation timed out")
+		buffer = self.receiveBuffers.get(size)
+		try:
+			received = os.readv(self.fd, [buffer])
+		finally:
+			self.receiveBuffers.put(buffer)
+		self.transfers += 1
+		return memoryview(buffer)[:received]
+
+	async def waitUntilReady(self, writing: bool = False):
+		# resolves as soon as the event loop reports the descriptor ready
+		loop = asyncio.get_event_loop()
+		future = loop.create_future()
+		add, remove = (loop.add_writer, loop.remove_writer) if writing else (loop.add_reader, loop.remove_reader)
+		add(self.fd, lambda: future.done() or future.set_result(None))
+		try:
+			await future
+		finally:
+			remove(self.fd)
+
+	def hasAsyncTransfers(self) -> bool:
+		return True
+
+	def getClientFile(self) -> Union[str, int]:
+		return self.clientFd
+
+	def close(self):
+		for fd in (self.fd, self.clientFd):
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+
+class PTY_Transport(File_Transport):
+	"""Pseudo terminal pair, the client opens the slave just like a /dev/ttyGS* gadget."""
+
+	def __init__(self, raw: bool = True):
+		fd, clientFd = pty.openpty()
+		# raw before the client opens it, otherwise the line discipline mangles everything the host writes before that,
+		# clients that want their commands echoed read lines and need the canonical tty
+		if raw:
+			tty.setraw(clientFd)
+		super().__init__(fd, clientFd)
+		self.clientFile = os.ttyname(clientFd)
+
+	def getClientFile(self) -> str:
+		return self.clientFile
+
+
+class Socket_Transport(File_Transport):
+	"""Unix socketpair, the client uses its end without any line discipline."""
+
+	def __init__(self):
+		hostSocket, clientSocket = socket.socketpair()
+		super().__init__(hostSocket.detach(), clientSocket.detach())
+
+
+def MakeTransport(transportType: TransportType, echo: bool = False) -> Transport:
+	if transportType == TransportType.PTY:
+		return PTY_Transport(raw=not echo)
+	elif transportType == TransportType.SOCKET:
+		return Socket_Transport()
+	raise ValueError("%s transports are created from the device registry" % transportType.value)
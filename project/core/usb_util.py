@@ -1,8 +1,14 @@
 import __init__
+import os
 import struct
+import zlib
+import lzma
 from functools import reduce
+import usb.backend.libusb1 as libusb1
 import usb.core as usbcore
 from collections import namedtuple
+import sys
+from typing import Container, Dict, Iterator, List, Tuple
 
 from util import ListEnum
 
@@ -16,6 +22,12 @@ USE_GT = True
 USE_ACM = True
 FUNC_TYPE = "Loopback" if not USE_ACM else "acm"
 
+# do the clients' ttys echo the host commands? Otherwise they are put into raw mode (binary clients never echo)
+USE_TTY_ECHO = False
+
+# which message framing should be used by default? (see ProtocolType)
+USE_BINARY_PROTOCOL = False
+
 CONFIGURATION_ID = 1 if USE_ACM else 0
 SETTING_ID = 0
 OUT_ENDPOINT_ID = 1
@@ -32,12 +44,16 @@ class MsgStatus(ListEnum):
 	OK = 1
 	FAIL = 2
 	ONGOING = 3
+	# set by the receiver if the payload does not match its checksum
+	CORRUPT = 4
 
 
 class MsgAction(ListEnum):
 	PING = 0
 	STOP = 1
 	CALCULATE = 2
+	BATCH = 3
+	HELLO = 4
 
 
 class MsgOperation(ListEnum):
@@ -53,6 +69,88 @@ class CommunicationType(ListEnum):
 	THREADING = "THREADING"
 	ASYNCIO = "ASYNCIO"
 	MULTIPROCESSING = "MULTIPROCESSING"
+	# a few processes, each driving a shard of the devices with an event loop
+	HYBRID = "HYBRID"
+	# a reader and a writer thread per device, requests wait for their answers as futures
+	ACTOR = "ACTOR"
+
+
+class ProtocolType(ListEnum):
+	TEXT = "TEXT"
+	BINARY = "BINARY"
+
+
+PROTOCOL_TYPE = ProtocolType.BINARY if USE_BINARY_PROTOCOL else ProtocolType.TEXT
+
+
+# which channel connects the host with its clients? Only USB needs the dummy_hcd gadgets
+class TransportType(ListEnum):
+	USB = "USB"
+	PTY = "PTY"
+	SOCKET = "SOCKET"
+
+
+TRANSPORT_TYPE = TransportType.USB
+
+
+# how does the host pick the device for its next load?
+class DeviceSelection(ListEnum):
+	ROUND_ROBIN = "ROUND_ROBIN"
+	# the device that is expected to answer first
+	LEAST_OUTSTANDING = "LEAST_OUTSTANDING"
+	# the better one of two random devices
+	POWER_OF_TWO = "POWER_OF_TWO"
+
+
+class Compression(ListEnum):
+	NONE = 0
+	ZLIB = 1
+	LZMA = 2
+
+
+# optional features a client reports in its answer to HELLO
+class Feature(ListEnum):
+	BATCH = 1
+	STREAM = 2
+	ZLIB = 4
+	LZMA = 8
+	CHECKSUM = 16
+
+
+# which codec should be used (and accepted) for large payloads of the binary protocol?
+COMPRESSION = Compression.NONE
+# smaller payloads are never compressed
+COMPRESSION_THRESHOLD = 1024
+
+# binary frame header: magic, flags, sender, status, action, operation, request id, chunk sequence, credit limit,
+# CRC32 of the uncompressed payload, payload length
+BINARY_MAGIC = 0xA5
+BINARY_HEADER = struct.Struct("<BBBBBBHIIII")
+MAX_REQUEST_ID = 0xFFFF
+
+# header flags: bits 0-1 codec of the payload, bits 2-3 codec the sender accepts for the answer, bit 4 answer should be streamed
+FLAG_CODEC_MASK = 0x03
+FLAG_ACCEPT_SHIFT = 2
+FLAG_ACCEPT_MASK = 0x0C
+FLAG_STREAM = 0x10
+
+# payload size of a single chunk of a streamed answer
+STREAM_CHUNK_SIZE = 4096
+
+# bytes a client accepts beyond the ones it has processed (size of the tty receive buffer)
+RECEIVE_WINDOW = 4096
+# byte counters for the flow control wrap around at 32 bit
+CREDIT_MASK = 0xFFFFFFFF
+
+# clients write their answers to the tty in pieces of this size
+WRITE_SIZE = 255
+# largest frame a client accepts
+MAX_FRAME_SIZE = 1 << 16
+# most requests a client handles in a single BATCH frame
+MAX_BATCH_SIZE = 64
+
+TEXT_DIGIT_OFFSET = ord("0")
+TEXT_MIN_FRAME_SIZE = len("~0000;\r")
 
 
 def byteArrToString(arr):
@@ -65,11 +163,27 @@ def getEnumValue(enum: ListEnum):
 	return enum if isinstance(enum, int) else enum.value
 
 
+def toBytes(data) -> bytes:
+	if isinstance(data, (bytes, bytearray, memoryview)):
+		return data
+	return str(data).encode("utf-8")
+
+
 def packMsg(sender: MsgSender, status: MsgStatus, action: MsgAction, operation: MsgOperation, data: str):
 	return "~%s%s%s%s%s;\r" % (getEnumValue(sender), getEnumValue(status), getEnumValue(action), getEnumValue(operation), data)
 
 
-UnpackedMsg = namedtuple("UnpackedMsg", ["isStart", "isEnd", "sender", "status", "action", "operation", "data"])
+# request id, compression, checksum, streaming and credits are only transmitted by the binary protocol,
+# wireSize is the size of the payload as it was transferred and dataSize the size of the (uncompressed) payload,
+# rtt is set by the host to the time from the start of the answered request until the answer arrived
+UnpackedMsg = namedtuple(
+	"UnpackedMsg",
+	[
+		"isStart", "isEnd", "sender", "status", "action", "operation", "data",
+		"requestId", "compression", "wireSize", "checksum", "dataSize", "sequence", "stream", "credits", "rtt"
+	],
+	defaults=[0, 0, 0, None, 0, 0, False, 0, None]
+)
 
 
 def unpackMsg(msg) -> UnpackedMsg:
@@ -95,25 +209,374 @@ def unpackMsg(msg) -> UnpackedMsg:
 		data = data[:-1]
 	if data[-1:] == ";":
 		data = data[:-1]
-	return UnpackedMsg._make([isStart, isEnd, int(sender), int(status), int(action), int(operation), data])
-
-
-def GetAllDevices():
-	devs = usbcore.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID, find_all=True)
-	return devs
+	return UnpackedMsg(isStart, isEnd, int(sender), int(status), int(action), int(operation), data)
+
+
+def compressPayload(payload, codec: int) -> bytes:
+	if codec == Compression.ZLIB.value:
+		return zlib.compress(payload, 1)
+	if codec == Compression.LZMA.value:
+		return lzma.compress(payload, preset=0)
+	return payload
+
+
+def decompressPayload(payload: memoryview, codec: int) -> bytes:
+	if codec == Compression.ZLIB.value:
+		return zlib.decompress(payload)
+	if codec == Compression.LZMA.value:
+		return lzma.decompress(payload)
+	return bytes(payload)
+
+
+def packBinaryMsg(
+	sender: MsgSender,
+	status: MsgStatus,
+	action: MsgAction,
+	operation: MsgOperation,
+	data=b"",
+	requestId: int = 0,
+	compression: Compression = Compression.NONE,
+	sequence: int = 0,
+	stream: bool = False,
+	credits: int = 0) -> bytes:
+
+	payload = toBytes(data)
+	checksum = zlib.crc32(payload)
+	codec = getEnumValue(compression)
+	flags = codec << FLAG_ACCEPT_SHIFT
+	if stream:
+		flags |= FLAG_STREAM
+	if codec != Compression.NONE.value and len(payload) >= COMPRESSION_THRESHOLD:
+		compressed = compressPayload(payload, codec)
+		# only use the compressed payload if it is actually smaller
+		if len(compressed) < len(payload):
+			payload = compressed
+			flags |= codec
+
+	header = BINARY_HEADER.pack(
+		BINARY_MAGIC,
+		flags,
+		getEnumValue(sender),
+		getEnumValue(status),
+		getEnumValue(action),
+		getEnumValue(operation),
+		requestId,
+		sequence,
+		credits,
+		checksum,
+		len(payload)
+	)
+	return header + payload
+
+
+def unpackBinaryMsg(frame: memoryview, checksum: int = None, stripOperations: Container[int] = ()) -> UnpackedMsg:
+	"""
+	Unpacks a complete binary frame, checksum can be given if the (uncompressed) payload was already checked while it arrived.
+	Such payloads of answers to stripOperations are not copied, only their size and checksum are kept.
+	"""
+	_, flags, sender, status, action, operation, requestId, sequence, credits, expectedChecksum, length = BINARY_HEADER.unpack_from(frame)
+	codec = flags & FLAG_CODEC_MASK
+	# chunks of streamed answers are still ongoing, their payloads are handed on
+	if checksum is not None and codec == Compression.NONE.value and operation in stripOperations and status != MsgStatus.ONGOING.value:
+		data, dataSize = b"", length
+	else:
+		data = decompressPayload(frame[BINARY_HEADER.size:BINARY_HEADER.size + length], codec)
+		dataSize = len(data)
+		if checksum is None or codec != Compression.NONE.value:
+			checksum = zlib.crc32(data)
+	if checksum != expectedChecksum:
+		status = MsgStatus.CORRUPT.value
+	return UnpackedMsg(
+		True,
+		True,
+		sender,
+		status,
+		action,
+		operation,
+		data,
+		requestId,
+		(flags & FLAG_ACCEPT_MASK) >> FLAG_ACCEPT_SHIFT,
+		length,
+		checksum,
+		dataSize,
+		sequence,
+		bool(flags & FLAG_STREAM),
+		credits
+	)
+
+
+# answer to HELLO: what a client supports and how the host should size its transfers
+Capabilities = namedtuple(
+	"Capabilities", ["maxFrameSize", "writeSize", "receiveWindow", "maxBatchSize", "streamChunkSize", "operations", "features"]
+)
+
+
+def packCapabilities(capabilities: Capabilities) -> str:
+	return ",".join(str(value) for value in capabilities)
+
+
+def unpackCapabilities(data) -> Capabilities:
+	if not isinstance(data, str):
+		data = str(data, "utf-8")
+	return Capabilities._make(int(value) for value in data.split(","))
+
+
+def unpackBatch(data) -> List[UnpackedMsg]:
+	"""Splits the payload of a BATCH message into the binary frames it consists of."""
+	messages = []
+	with memoryview(data) as view:
+		offset = 0
+		while offset + BINARY_HEADER.size <= len(view):
+			end = offset + BINARY_HEADER.size + BINARY_HEADER.unpack_from(view, offset)[-1]
+			messages.append(unpackBinaryMsg(view[offset:end]))
+			offset = end
+	return messages
+
+
+def unpackTextFrame(frame: memoryview) -> UnpackedMsg:
+	# frame layout: "~" + four single digit fields + data + ";\r"
+	sender, status, action, operation = (c - TEXT_DIGIT_OFFSET for c in frame[1:5])
+	data = str(frame[5:-2], "utf-8")
+	return UnpackedMsg(True, True, sender, status, action, operation, data, wireSize=len(frame) - TEXT_MIN_FRAME_SIZE, dataSize=len(data))
+
+
+def unpackFrame(frame: memoryview, protocol: ProtocolType, checksum: int = None, stripOperations: Container[int] = ()) -> UnpackedMsg:
+	if protocol == ProtocolType.BINARY:
+		return unpackBinaryMsg(frame, checksum, stripOperations)
+	return unpackTextFrame(frame)
+
+
+def stripPayload(msg: UnpackedMsg) -> UnpackedMsg:
+	"""Drops the payload of a verified message, only its size and checksum are kept."""
+	if not msg or msg.checksum is None:
+		return msg
+	return msg._replace(data=b"")
+
+
+class FrameDecoder:
+	"""
+	Collects the raw reads of a single device in one reusable buffer and splits them into complete frames.
+	The parse position is kept across reads, so every byte is only scanned once.
+	"""
+
+	def __init__(self, protocol: ProtocolType = PROTOCOL_TYPE, stripOperations: Container[int] = ()):
+		self.protocol = protocol
+		# answers to these operations are verified by their checksum, their payloads are not needed
+		self.stripOperations = stripOperations
+		self.buffer = bytearray()
+		# start of the next frame
+		self.pos = 0
+		# where the search for the end of a text frame continues
+		self.scanPos = 0
+		# running CRC32 of the binary payload starting at checksumStart, up to checksumPos
+		self.checksum = 0
+		self.checksumStart = -1
+		self.checksumPos = 0
+
+	def feed(self, data):
+		if self.pos > 0:
+			del self.buffer[:self.pos]
+			self.scanPos -= self.pos
+			self.checksumStart -= self.pos
+			self.checksumPos -= self.pos
+			self.pos = 0
+		self.buffer += data
+
+	def reset(self):
+		self.buffer.clear()
+		self.pos = 0
+		self.scanPos = 0
+		self.checksumStart = -1
+		self.checksumPos = 0
+
+	def unpack(self, frame: memoryview) -> UnpackedMsg:
+		"""Unpacks the frame that was yielded last."""
+		payloadStart = self.pos - len(frame) + BINARY_HEADER.size
+		checksum = self.checksum if self.checksumStart == payloadStart and self.checksumPos == self.pos else None
+		return unpackFrame(frame, self.protocol, checksum, self.stripOperations)
+
+	def frames(self) -> Iterator[memoryview]:
+		"""Yields all complete frames. A frame is only valid until the next frame is requested."""
+		while (end := self.findFrameEnd()) > 0:
+			start = self.pos
+			self.pos = end
+			with memoryview(self.buffer) as view:
+				frame = view[start:end]
+				try:
+					yield frame
+				finally:
+					frame.release()
+
+	def findFrameEnd(self) -> int:
+		if self.protocol == ProtocolType.BINARY:
+			return self.findBinaryFrameEnd()
+		return self.findTextFrameEnd()
+
+	def findBinaryFrameEnd(self) -> int:
+		while len(self.buffer) - self.pos >= BINARY_HEADER.size:
+			# skip garbage until the next frame start
+			if self.buffer[self.pos] != BINARY_MAGIC:
+				self.pos += 1
+				continue
+			flags = self.buffer[self.pos + 1]
+			payloadStart = self.pos + BINARY_HEADER.size
+			end = payloadStart + BINARY_HEADER.unpack_from(self.buffer, self.pos)[-1]
+			if not flags & FLAG_CODEC_MASK:
+				self.updateChecksum(payloadStart, min(end, len(self.buffer)))
+			return end if end <= len(self.buffer) else -1
+		return -1
+
+	def updateChecksum(self, payloadStart: int, available: int):
+		# the payload is checked while it arrives, so a complete frame is already verified
+		if self.checksumStart != payloadStart:
+			self.checksumStart = payloadStart
+			self.checksumPos = payloadStart
+			self.checksum = 0
+		with memoryview(self.buffer) as view:
+			self.checksum = zlib.crc32(view[self.checksumPos:available], self.checksum)
+		self.checksumPos = available
+
+	def findTextFrameEnd(self) -> int:
+		while True:
+			start = self.buffer.find(b"~", self.pos)
+			if start < 0:
+				self.pos = len(self.buffer)
+				return -1
+			self.pos = start
+			end = self.buffer.find(b";\r", max(self.scanPos, start))
+			if end < 0:
+				self.scanPos = max(len(self.buffer) - 1, start)
+				return -1
+			self.scanPos = end + 2
+			if end + 2 - start >= TEXT_MIN_FRAME_SIZE:
+				return end + 2
+			# too short to be a frame, continue behind it
+			self.pos = end + 2
+
+
+# gadgets are identified by their serial number, the bus position tells gadgets with equal serials apart
+DeviceKey = namedtuple("DeviceKey", ["serial", "bus", "address"])
+
+
+def getDeviceKey(device: usbcore.Device) -> DeviceKey:
+	try:
+		serial = device.serial_number or ""
+	except (ValueError, usbcore.USBError):
+		serial = ""
+	return DeviceKey(serial, device.bus, device.address)
+
+
+def openEndpoints(device: usbcore.Device) -> Tuple[usbcore.Endpoint, usbcore.Endpoint]:
+	if device.is_kernel_driver_active(0):
+		try:
+			device.detach_kernel_driver(0)
+		except usbcore.USBError as e:
+			sys.exit("Kernel driver could not be detached: %s" % str(e))
+
+	cfg = device.get_active_configuration()
+	interface = cfg[(CONFIGURATION_ID, SETTING_ID)]
+	return interface[OUT_ENDPOINT_ID], interface[IN_ENDPOINT_ID]
+
+
+class DeviceRegistry:
+	"""Enumerates the gadgets once and caches them together with their endpoints.
+	Devices are sorted by their key, so indices stay the same across runs."""
+
+	def __init__(self):
+		self.devices: Dict[DeviceKey, usbcore.Device] = {}
+		self.endpoints: Dict[DeviceKey, Tuple[usbcore.Endpoint, usbcore.Endpoint]] = {}
+		self.keys: List[DeviceKey] = []
+		self.enumerated = False
+		self.pid = os.getpid()
+
+	def checkProcess(self):
+		"""USB handles don't survive a fork: a child keeps the keys, but finds every gadget it uses again by itself."""
+		if self.pid != os.getpid():
+			self.pid = os.getpid()
+			self.devices = dict.fromkeys(self.devices)
+			self.endpoints = {}
+
+	def refresh(self) -> Tuple[List[DeviceKey], List[DeviceKey]]:
+		"""Enumerates the bus again, but only opens gadgets that weren't known before.
+		Returns the keys of the added and removed gadgets."""
+		self.checkProcess()
+		known = {(key.bus, key.address): key for key in self.devices}
+		found = set()
+		added = []
+		for device in usbcore.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID, find_all=True, backend=GetBackend()):
+			key = known.get((device.bus, device.address))
+			if key is None:
+				key = getDeviceKey(device)
+				# reading the serial opened the gadget, a handle of the parent must not be inherited by forked workers
+				device.finalize()
+				added.append(key)
+			if self.devices.get(key) is None:
+				self.devices[key] = device
+			found.add(key)
+
+		removed = [key for key in self.devices if key not in found]
+		for key in removed:
+			self.endpoints.pop(key, None)
+			device = self.devices.pop(key)
+			try:
+				if device is not None:
+					device.finalize()
+			except usbcore.USBError:
+				pass
+		self.keys = sorted(self.devices)
+		self.enumerated = True
+		return added, removed
+
+	def getKeys(self) -> List[DeviceKey]:
+		if not self.enumerated:
+			self.refresh()
+		return self.keys
+
+	def getDevice(self, key: DeviceKey) -> usbcore.Device:
+		self.checkProcess()
+		if self.devices[key] is None:
+			self.devices[key] = usbcore.find(
+				idVendor=VENDOR_ID, idProduct=PRODUCT_ID, bus=key.bus, address=key.address, backend=GetBackend())
+		return self.devices[key]
+
+	def getEndpoints(self, key: DeviceKey) -> Tuple[usbcore.Endpoint, usbcore.Endpoint]:
+		self.checkProcess()
+		if key not in self.endpoints:
+			self.endpoints[key] = openEndpoints(self.getDevice(key))
+		return self.endpoints[key]
+
+
+backend = None
+backendPid: int = None
+
+
+def GetBackend():
+	# pyusb keeps a single libusb context, a forked child must not go on with the one of its parent
+	global backend, backendPid
+	if backend is None or backendPid != os.getpid():
+		libusb1._lib_object = None
+		backend = libusb1.get_backend()
+		backendPid = os.getpid()
+	return backend
+
+
+DEVICE_REGISTRY = DeviceRegistry()
+
+
+def RefreshDevices() -> Tuple[List[DeviceKey], List[DeviceKey]]:
+	return DEVICE_REGISTRY.refresh()
+
+
+def GetAllDevices() -> List[usbcore.Device]:
+	return [DEVICE_REGISTRY.getDevice(key) for key in DEVICE_REGISTRY.getKeys()]
 
 
 def GetDeviceCount():
-	devs = usbcore.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID, find_all=True)
-	count = 0
-	for dev in devs:
-		count += 1
-		dev.finalize()
-	return count
+	DEVICE_REGISTRY.refresh()
+	return len(DEVICE_REGISTRY.getKeys())
 
 
 def GetDevice(index: int):
-	devs = usbcore.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID, find_all=True)
-	for i, dev in enumerate(devs):
-		if i == index:
-			return dev
+	keys = DEVICE_REGISTRY.getKeys()
+	if index < len(keys):
+		return DEVICE_REGISTRY.getDevice(keys[index])
@@ -163,6 +163,8 @@ class DataVisualizer:
 			CommunicationType.THREADING: 1,
 			CommunicationType.ASYNCIO: 2,
 			CommunicationType.MULTIPROCESSING: 3,
+			CommunicationType.HYBRID: 4,
+			CommunicationType.ACTOR: 5,
 		}
 		with MeasurementFile() as mf:
 			variances = mf.getAvailableVarianceMeasurements(comType)
@@ -656,6 +658,8 @@ def showOperationProgression(showLog=False):
 		CommunicationType.THREADING: 1,
 		CommunicationType.ASYNCIO: 2,
 		CommunicationType.MULTIPROCESSING: 3,
+		CommunicationType.HYBRID: 4,
+		CommunicationType.ACTOR: 5,
 	}
 
 	for comType in [CommunicationType.BASIC]:
@@ -687,6 +691,8 @@ def showDeviceCountProgression(opCount: int = 10000, tSize: int = 100):
 		CommunicationType.THREADING: 1,
 		CommunicationType.ASYNCIO: 2,
 		CommunicationType.MULTIPROCESSING: 3,
+		CommunicationType.HYBRID: 4,
+		CommunicationType.ACTOR: 5,
 	}
 	width = 0.8 / (3)
 	X = np.arange(5)
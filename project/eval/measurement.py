@@ -2,7 +2,7 @@ import __init__
 from itertools import product
 from usb_testload import TestLoad
 from core.usb_manager import GetAndActivateHost, ProcessTestLoad
-from typing import List
+from typing import Dict, List
 import time
 import numpy as np
 
@@ -22,11 +22,24 @@ DEVICE_COUNTS = [1, 2, 4, 8, 16, 32]
 LOADS_PER_DEVICE = [1, 2, 4]
 REPEAT_COUNT = 10
 
+# additional per request byte counts, stored next to the timings
+TRANSFER_MEASUREMENTS = {
+	"RawBytes": "Average payload bytes per answer",
+	"WireBytes": "Average transferred payload bytes per answer",
+	"SavedEchoBytes": "Average bytes per request the client tty did not echo back",
+	"LoadTime": "Average time a single load took on its device",
+	"ComputeTime": "Average time of the host side calculation of a single load",
+	"Transfers": "Average IN transfers per answer",
+	"Allocations": "Average newly allocated receive buffers per answer",
+	"Timeouts": "Average reads per answer that timed out"
+}
 
-def runTestsFor(comType: CommunicationType, totalLoads: int = 1) -> MeasurementTable:
+
+def runTestsFor(comType: CommunicationType, totalLoads: int = 1, transferTabs: Dict[str, MeasurementTable] = None) -> MeasurementTable:
 	print("\nPrepare Tests...")
 	host = GetAndActivateHost(comType)
 	host.prepareDevices()
+	print("Transfers: %s" % host.getTransferMode())
 
 	# sometimes the first communication with a device is a little slower after the devices were created,
 	# so we ping them here to let the ping take up the creation delay
@@ -39,8 +52,18 @@ def runTestsFor(comType: CommunicationType, totalLoads: int = 1) -> MeasurementT
 		tl = TestLoad(opCount, tSize)
 		ProcessTestLoad(host, tl, totalLoads, REPEAT_COUNT)
 		tab.insert(opCount, tSize, tl.getAvgTime())
+		if transferTabs:
+			transferTabs["RawBytes"].insert(opCount, tSize, tl.getAvgRawBytes())
+			transferTabs["WireBytes"].insert(opCount, tSize, tl.getAvgWireBytes())
+			transferTabs["SavedEchoBytes"].insert(opCount, tSize, tl.getAvgSavedEchoBytes())
+			transferTabs["LoadTime"].insert(opCount, tSize, tl.getAvgLoadTime())
+			transferTabs["ComputeTime"].insert(opCount, tSize, tl.getAvgComputeTime())
+			transferTabs["Transfers"].insert(opCount, tSize, tl.getAvgTransfers())
+			transferTabs["Allocations"].insert(opCount, tSize, tl.getAvgAllocations())
+			transferTabs["Timeouts"].insert(opCount, tSize, tl.getAvgTimeouts())
 
 	host.deactivate()
+	host.close()
 	return tab
 
 
@@ -48,6 +71,7 @@ def runDetailedTestsFor(comType: CommunicationType, totalLoads: int = 1) -> Meas
 	print("\nPrepare Tests...")
 	host = GetAndActivateHost(comType)
 	host.prepareDevices()
+	print("Transfers: %s" % host.getTransferMode())
 
 	# sometimes the first communication with a device is a little slower after the devices were created,
 	# so we ping them here to let the ping take up the creation delay
@@ -62,6 +86,7 @@ def runDetailedTestsFor(comType: CommunicationType, totalLoads: int = 1) -> Meas
 		tab.insert(opCount, tSize, tl.getAllTimes())
 
 	host.deactivate()
+	host.close()
 	return tab
 
 
@@ -89,6 +114,7 @@ def runVarianceTestFor(comType: CommunicationType, opCount: int, tSize: int, rep
 
 	if not origHost:
 		host.deactivate()
+		host.close()
 	return results
 
 
@@ -98,6 +124,7 @@ def runVarianceTestsForAll(comType: CommunicationType, repeats: int, altAsyncio
 
 	host = GetAndActivateHost(comType)
 	host.prepareDevices()
+	print("Transfers: %s" % host.getTransferMode())
 
 	# sometimes the first communication with a device is a little slower after the devices were created,
 	# so we ping them here to let the ping take up the creation delay
@@ -113,6 +140,7 @@ def runVarianceTestsForAll(comType: CommunicationType, repeats: int, altAsyncio
 		curProgress += 1
 
 	host.deactivate()
+	host.close()
 
 
 def runAutomatedTests(devices: List[int], totalLoads: List[int], comType: CommunicationType, multiplyLoadCount: bool = False):
@@ -135,7 +163,8 @@ def runAutomatedTests(devices: List[int], totalLoads: List[int], comType: Commun
 			measureName = "%s/%s" % (totalLoad, deviceCount)
 
 			time.sleep(0.5)
-			table = runTestsFor(comType, totalLoad)
+			transferTabs = {name: MeasurementTable(OPERATION_COUNTS, TRANSFER_SIZES) for name in TRANSFER_MEASUREMENTS}
+			table = runTestsFor(comType, totalLoad, transferTabs)
 			data = table.export()
 
 			with MeasurementFile() as mf:
@@ -145,6 +174,8 @@ def runAutomatedTests(devices: List[int], totalLoads: List[int], comType: Commun
 					"Device Count": deviceCount
 				})
 				mf.addMeasurementData(measureName, comType, data, {"Repeats": REPEAT_COUNT})
+				for name, info in TRANSFER_MEASUREMENTS.items():
+					mf.addMeasurementData("%s/%s" % (measureName, name), comType, transferTabs[name].export(), {"Info": info})
 
 		setup(SetupTypes.CLEAR)
 
@@ -1,8 +1,9 @@
 from __future__ import annotations  # to make class types work inside the class itself
 from functools import reduce
-from typing import List, Tuple
+from typing import List, Tuple, Union
 import numpy as np
 import time
+import zlib
 from timeit import default_timer as timer  # default timer uses best timer, automatically chosen for the OS
 
 
@@ -12,11 +13,26 @@ class TestLoad():
 		self.count = count
 		self.dataLen = dataLen
 		self.data = "a" * dataLen
+		self.rawData = self.data.encode("utf-8")
+		self.checksum = zlib.crc32(self.rawData)
 		self.times = []
 		self.time = 0
+		# time every single load took on its device and in the host side calculation
+		self.loadTimes = []
+		self.computeTimes = []
 		self.tryCount = 0
 		self.successCount = 0
 		self.success = False
+		# payload bytes of all answers, before and after compression
+		self.rawBytes = 0
+		self.wireBytes = 0
+		# bytes the clients did not have to echo back
+		self.savedEchoBytes = 0
+		# IN transfers and newly allocated receive buffers on the host
+		self.transfers = 0
+		self.allocations = 0
+		# reads that gave up waiting for an answer
+		self.timeouts = 0
 
 	def startMeasure(self):
 		self.__startTime = timer()
@@ -29,17 +45,43 @@ class TestLoad():
 		self.times.append(time)
 		self.time += time
 
+	def addLoadTimes(self, loadTimes: List[float]):
+		self.loadTimes += loadTimes
+
+	def addComputeTimes(self, computeTimes: List[float]):
+		self.computeTimes += computeTimes
+
+	def addTransferCounts(self, transfers: int, allocations: int):
+		self.transfers += transfers
+		self.allocations += allocations
+
+	def addTimeouts(self, timeouts: int):
+		self.timeouts += timeouts
+
 	def addFailedTry(self):
 		self.tryCount += 1
 
-	def checkResult(self, data: str, noConfirm: bool = False):
-		success = data == self.data
+	def addTransferSize(self, rawSize: int, wireSize: int, savedEchoSize: int = 0):
+		self.rawBytes += rawSize
+		self.wireBytes += wireSize
+		self.savedEchoBytes += savedEchoSize
+
+	def checkResult(self, data: Union[str, bytes], noConfirm: bool = False):
+		success = data == (self.data if isinstance(data, str) else self.rawData)
 		if success:
 			self.successCount += 1
 		else:
 			print("%s <-> %s" % (len(data), len(self.data)))
 		self.tryCount += 1
 
+	def checkChecksum(self, checksum: int, dataLen: int):
+		success = checksum == self.checksum and dataLen == self.dataLen
+		if success:
+			self.successCount += 1
+		else:
+			print("%s <-> %s (checksum)" % (dataLen, self.dataLen))
+		self.tryCount += 1
+
 	def getAvgTime(self):
 		if self.successCount < 1:
 			return -1
@@ -52,13 +94,51 @@ class TestLoad():
 	def getAllTimes(self):
 		return self.times
 
+	def getAllLoadTimes(self):
+		return self.loadTimes
+
+	def getAvgLoadTime(self):
+		return sum(self.loadTimes) / len(self.loadTimes) if self.loadTimes else -1
+
+	def getAllComputeTimes(self):
+		return self.computeTimes
+
+	def getAvgComputeTime(self):
+		return sum(self.computeTimes) / len(self.computeTimes) if self.computeTimes else -1
+
+	def getAvgRawBytes(self):
+		return self.rawBytes / self.tryCount if self.tryCount > 0 else 0
+
+	def getAvgWireBytes(self):
+		return self.wireBytes / self.tryCount if self.tryCount > 0 else 0
+
+	def getAvgSavedEchoBytes(self):
+		return self.savedEchoBytes / self.tryCount if self.tryCount > 0 else 0
+
+	def getAvgTransfers(self):
+		return self.transfers / self.tryCount if self.tryCount > 0 else 0
+
+	def getAvgAllocations(self):
+		return self.allocations / self.tryCount if self.tryCount > 0 else 0
+
+	def getAvgTimeouts(self):
+		return self.timeouts / self.tryCount if self.tryCount > 0 else 0
+
 	def reset(self):
 		self.cancelMeasure()
 		self.time = 0
 		self.times = []
+		self.loadTimes = []
+		self.computeTimes = []
 		self.tryCount = 0
 		self.successCount = 0
 		self.success = False
+		self.rawBytes = 0
+		self.wireBytes = 0
+		self.savedEchoBytes = 0
+		self.transfers = 0
+		self.allocations = 0
+		self.timeouts = 0
 
 	# should also include steps!!!
 	@staticmethod
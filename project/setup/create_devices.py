@@ -221,10 +221,11 @@ def create():
 			createNewGadget(i, vendor, product)
 		else:
 			name = "usb_%s" % i
-			runRootCommand("gt create %s idProduct=%s idVendor=%s product='Virtual USB Device' manufacturer='USB Setup Helper' serialnumber='000'" % (
+			runRootCommand("gt create %s idProduct=%s idVendor=%s product='Virtual USB Device' manufacturer='USB Setup Helper' serialnumber='%03d'" % (
 				name,
 				product,
-				vendor)
+				vendor,
+				i)
 			)
 			runRootCommand("gt config create %s def 1" % name)
 
@@ -0,0 +1,101 @@
+import __init__
+import asyncio
+import ctypes
+import threading
+import unittest
+import usb.core as usbcore
+
+import core.usb_libusb as usb_libusb
+from core.usb_libusb import LIBUSB_AVAILABLE, TRANSFER_COMPLETED, TRANSFER_TIMED_OUT, LibUSB_Context, LibUSB_Endpoint
+
+
+class CompletingLib:
+	"""Passes everything to libusb, but completes submitted transfers right away instead of sending them to a device."""
+
+	def __init__(self, lib, status: int = TRANSFER_COMPLETED, data: bytes = b"", result: int = 0):
+		self.lib = lib
+		self.status = status
+		self.data = data
+		self.result = result
+
+	def __getattr__(self, name: str):
+		return getattr(self.lib, name)
+
+	def libusb_submit_transfer(self, transfer) -> int:
+		if self.result < 0:
+			return self.result
+		t = transfer.contents
+		ctypes.memmove(t.buffer, self.data, len(self.data))
+		t.status = self.status
+		t.actual_length = len(self.data)
+		# libusb calls back from its event handling, the callback has to cope with any thread
+		threading.Thread(target=t.callback, args=(transfer,)).start()
+		return 0
+
+
+@unittest.skipUnless(LIBUSB_AVAILABLE, "libusb-1.0 is not installed")
+class USB_LibUSB_Test(unittest.TestCase):
+
+	def setUp(self):
+		self.lib = usb_libusb.LIB
+
+	def test_context(self):
+		ctx = LibUSB_Context()
+		self.assertTrue(ctx.ctx.value)
+		ctx.startEvents()
+		self.assertTrue(ctx.eventThread.is_alive())
+		ctx.close()
+		self.assertFalse(ctx.eventThread.is_alive())
+
+		# every process keeps a single context until it is closed
+		self.assertIs(usb_libusb.GetContext(), usb_libusb.GetContext())
+		usb_libusb.CloseContext()
+		self.assertIsNone(usb_libusb.context)
+
+	def test_submit(self):
+		ctx = LibUSB_Context()
+		try:
+			usb_libusb.LIB = CompletingLib(self.lib, data=b"answer")
+			done = threading.Event()
+			results = []
+
+			def callback(status: int, data: bytes):
+				results.append((status, data))
+				done.set()
+
+			ctx.submit(None, 0x81, (ctypes.c_ubyte * 64)(), callback, 100)
+			self.assertTrue(done.wait(1))
+			self.assertEqual(results, [(TRANSFER_COMPLETED, b"answer")])
+			self.assertEqual(ctx.pending, {})
+
+			# a transfer libusb refuses is not kept and raises like pyusb
+			usb_libusb.LIB = CompletingLib(self.lib, result=-1)
+			with self.assertRaises(usbcore.USBError):
+				ctx.submit(None, 0x81, (ctypes.c_ubyte * 64)(), callback, 100)
+			self.assertEqual(ctx.pending, {})
+		finally:
+			usb_libusb.LIB = self.lib
+			ctx.close()
+
+	def test_async_transfers(self):
+		# completions of the event thread resolve the futures on the asyncio loop
+		ctx = LibUSB_Context()
+		endpoint = LibUSB_Endpoint(ctx, None, 0x81, 512)
+
+		async def read():
+			return await endpoint.readAsync(512)
+
+		try:
+			usb_libusb.LIB = CompletingLib(self.lib, data=b"answer")
+			self.assertEqual(asyncio.run(read()), b"answer")
+
+			usb_libusb.LIB = CompletingLib(self.lib, TRANSFER_TIMED_OUT)
+			with self.assertRaises(usbcore.USBTimeoutError):
+				asyncio.run(read())
+		finally:
+			usb_libusb.LIB = self.lib
+			ctx.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,94 @@
+import __init__
+import unittest
+
+from core.usb_util import MsgSender, MsgStatus, MsgAction, MsgOperation, packMsg, unpackMsg, packBinaryMsg, unpackBatch
+from core.usb_util import ProtocolType, Compression, FrameDecoder, unpackBinaryMsg
+from core.usb_util import Capabilities, Feature, packCapabilities, unpackCapabilities
+
+
+class USB_Protocol_Test(unittest.TestCase):
+
+	def test_text(self):
+		msg = unpackMsg(packMsg(MsgSender.CLIENT, MsgStatus.OK, MsgAction.CALCULATE, MsgOperation.TESTLOAD, "aaaa"))
+		self.assertTrue(msg.isStart and msg.isEnd)
+		self.assertEqual(msg.data, "aaaa")
+
+	def decode(self, decoder: FrameDecoder, data: bytes):
+		decoder.feed(data)
+		return [decoder.unpack(frame) for frame in decoder.frames()]
+
+	def test_binary(self):
+		decoder = FrameDecoder(ProtocolType.BINARY)
+		frame = packBinaryMsg(MsgSender.CLIENT, MsgStatus.OK, MsgAction.CALCULATE, MsgOperation.TESTLOAD, b"a;\r~" * 100, 7)
+		messages = self.decode(decoder, b"\x00" + frame + frame[:5])
+		self.assertEqual(len(messages), 1)
+		self.assertEqual(messages[0].data, b"a;\r~" * 100)
+		self.assertEqual(messages[0].operation, MsgOperation.TESTLOAD.value)
+		self.assertEqual(messages[0].requestId, 7)
+
+		# the incomplete frame stays buffered until the rest arrives
+		self.assertEqual(len(self.decode(decoder, frame[5:])), 1)
+		self.assertEqual(len(decoder.buffer) - decoder.pos, 0)
+
+	def test_checksum(self):
+		decoder = FrameDecoder(ProtocolType.BINARY)
+		frame = bytearray(packBinaryMsg(MsgSender.CLIENT, MsgStatus.OK, MsgAction.CALCULATE, MsgOperation.TESTLOAD, b"a" * 1000))
+		messages = []
+		for i in range(0, len(frame), 100):
+			messages += self.decode(decoder, frame[i:i + 100])
+		self.assertEqual(messages[0].status, MsgStatus.OK.value)
+		self.assertEqual(messages[0].dataSize, 1000)
+
+		frame[-1] = ord("b")
+		self.assertEqual(self.decode(decoder, frame)[0].status, MsgStatus.CORRUPT.value)
+
+	def test_stripped_payload(self):
+		# verified test load answers keep only their size and checksum, anything else keeps its payload
+		decoder = FrameDecoder(ProtocolType.BINARY, (MsgOperation.TESTLOAD.value,))
+		frame = bytearray(packBinaryMsg(MsgSender.CLIENT, MsgStatus.OK, MsgAction.CALCULATE, MsgOperation.TESTLOAD, b"a" * 1000))
+		other = packBinaryMsg(MsgSender.CLIENT, MsgStatus.OK, MsgAction.CALCULATE, MsgOperation.MULTIPLY, b"1000")
+		chunk = packBinaryMsg(MsgSender.CLIENT, MsgStatus.ONGOING, MsgAction.CALCULATE, MsgOperation.TESTLOAD, b"a" * 1000)
+		messages = self.decode(decoder, frame + other + chunk)
+		self.assertEqual(messages[0].data, b"")
+		self.assertEqual(messages[0].dataSize, 1000)
+		self.assertEqual(messages[0].status, MsgStatus.OK.value)
+		self.assertEqual(messages[1].data, b"1000")
+		self.assertEqual(messages[2].data, b"a" * 1000)
+
+		frame[-1] = ord("b")
+		self.assertEqual(self.decode(decoder, frame)[0].status, MsgStatus.CORRUPT.value)
+
+	def test_batch(self):
+		batch = b"".join(packBinaryMsg(MsgSender.HOST, MsgStatus.OK, MsgAction.CALCULATE, MsgOperation.MULTIPLY, str(i), i) for i in range(10))
+		messages = unpackBatch(batch)
+		self.assertEqual([msg.requestId for msg in messages], list(range(10)))
+		self.assertEqual([int(msg.data) for msg in messages], list(range(10)))
+
+	def test_compression(self):
+		for compression in Compression:
+			frame = packBinaryMsg(MsgSender.CLIENT, MsgStatus.OK, MsgAction.CALCULATE, MsgOperation.TESTLOAD, b"a" * 10000, 1, compression)
+			msg = unpackBinaryMsg(memoryview(frame))
+			self.assertEqual(msg.data, b"a" * 10000)
+			self.assertEqual(msg.compression, compression.value)
+			self.assertEqual(msg.wireSize < 10000, compression != Compression.NONE)
+
+	def test_text_stream(self):
+		decoder = FrameDecoder(ProtocolType.TEXT)
+		echo = packMsg(MsgSender.HOST, MsgStatus.OK, MsgAction.CALCULATE, MsgOperation.TESTLOAD, "1000").replace("\r", "\r\n")
+		answer = packMsg(MsgSender.CLIENT, MsgStatus.OK, MsgAction.CALCULATE, MsgOperation.TESTLOAD, "a" * 1000)
+		stream = (echo + answer).encode("utf-8")
+		messages = []
+		for i in range(0, len(stream), 64):
+			messages += self.decode(decoder, stream[i:i + 64])
+		self.assertEqual([msg.sender for msg in messages], [MsgSender.HOST.value, MsgSender.CLIENT.value])
+		self.assertEqual(messages[1].data, "a" * 1000)
+
+	def test_capabilities(self):
+		capabilities = Capabilities(65536, 255, 4096, 64, 4096, 6, Feature.BATCH.value | Feature.STREAM.value)
+		packed = packCapabilities(capabilities)
+		self.assertEqual(unpackCapabilities(packed), capabilities)
+		self.assertEqual(unpackCapabilities(packed.encode("utf-8")), capabilities)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,120 @@
+import __init__
+import time
+import unittest
+import usb.core as usbcore
+
+import core.usb_util as usb_util
+import core.usb_host as usb_host
+from core.usb_util import CONFIGURATION_ID, SETTING_ID, OUT_ENDPOINT_ID, IN_ENDPOINT_ID, DeviceKey, DeviceRegistry, ProtocolType, TransportType
+from core.usb_host import USB_Host, USB_Host_Actor
+
+
+class FakeEndpoint:
+	wMaxPacketSize = 512
+
+	def read(self, buffer, timeout: int = 1000):
+		time.sleep(timeout / 1000)
+		raise usbcore.USBTimeoutError("Operation timed out")
+
+	def write(self, data) -> int:
+		return len(data)
+
+
+class FakeDevice:
+	"""Stands in for a pyusb device, a handle is opened by reading the serial and closed by finalize."""
+
+	def __init__(self, serial: str, address: int):
+		self.serial = serial
+		self.bus = 1
+		self.address = address
+		self.opened = False
+		self.finalized = 0
+
+	@property
+	def serial_number(self) -> str:
+		self.opened = True
+		return self.serial
+
+	def finalize(self):
+		self.opened = False
+		self.finalized += 1
+
+	def is_kernel_driver_active(self, interface: int) -> bool:
+		return False
+
+	def get_active_configuration(self):
+		return {(CONFIGURATION_ID, SETTING_ID): {OUT_ENDPOINT_ID: FakeEndpoint(), IN_ENDPOINT_ID: FakeEndpoint()}}
+
+
+class USB_Registry_Test(unittest.TestCase):
+	"""Plugs fake gadgets in and out through a stubbed usb.core.find."""
+
+	def setUp(self):
+		self.gadgets = []
+		self.find = usb_util.usbcore.find
+		self.registry = usb_util.DEVICE_REGISTRY
+		usb_util.usbcore.find = self.findGadgets
+		usb_util.DEVICE_REGISTRY = usb_host.DEVICE_REGISTRY = DeviceRegistry()
+
+	def tearDown(self):
+		usb_util.usbcore.find = self.find
+		usb_util.DEVICE_REGISTRY = usb_host.DEVICE_REGISTRY = self.registry
+
+	def findGadgets(self, find_all: bool = False, bus: int = None, address: int = None, **kwargs):
+		if find_all:
+			return iter(self.gadgets)
+		return next((gadget for gadget in self.gadgets if (gadget.bus, gadget.address) == (bus, address)), None)
+
+	def test_refresh(self):
+		first, second, third = FakeDevice("b", 2), FakeDevice("a", 3), FakeDevice("c", 4)
+		registry = usb_util.DEVICE_REGISTRY
+		self.gadgets = [first, second]
+		added, removed = registry.refresh()
+		self.assertEqual(registry.getKeys(), [DeviceKey("a", 1, 3), DeviceKey("b", 1, 2)])
+		self.assertEqual(sorted(added), registry.getKeys())
+		self.assertEqual(removed, [])
+		# the handles opened for the serials are closed again, nothing is left open for forked workers
+		self.assertFalse(first.opened or second.opened)
+
+		self.gadgets = [FakeDevice("a", 3), third]
+		added, removed = registry.refresh()
+		self.assertEqual(added, [DeviceKey("c", 1, 4)])
+		self.assertEqual(removed, [DeviceKey("b", 1, 2)])
+		self.assertEqual(registry.getKeys(), [DeviceKey("a", 1, 3), DeviceKey("c", 1, 4)])
+		# known gadgets are not read again
+		self.assertIs(registry.getDevice(DeviceKey("a", 1, 3)), second)
+		self.assertEqual(first.finalized, 2)
+
+	def test_host_refresh(self):
+		# unplugged gadgets lose their transport and actor, the others keep their state
+		for hostType in (USB_Host, USB_Host_Actor):
+			with self.subTest(hostType=hostType.__name__):
+				usb_util.DEVICE_REGISTRY = usb_host.DEVICE_REGISTRY = DeviceRegistry()
+				first, second = FakeDevice("a", 2), FakeDevice("b", 3)
+				self.gadgets = [first, second]
+				host = hostType(2, ProtocolType.BINARY, transportType=TransportType.USB)
+				try:
+					host.prepareDevices()
+					removed, kept = host.getDevices(-1)
+					kept.rtt = 0.01
+					finalized = first.finalized
+					removedActor = host.actors[removed] if isinstance(host, USB_Host_Actor) else None
+
+					self.gadgets = [second, FakeDevice("c", 4)]
+					host.refreshedAt -= usb_host.DEVICE_REFRESH_INTERVAL
+					devices = host.getDevices(-1)
+					self.assertEqual([dev.key.serial for dev in devices], ["b", "c"])
+					self.assertIs(devices[0], kept)
+					self.assertEqual(kept.rtt, 0.01)
+					self.assertEqual(host.getCount(), 2)
+					self.assertGreater(first.finalized, finalized)
+					if isinstance(host, USB_Host_Actor):
+						self.assertNotIn(removed, host.actors)
+						self.assertIn(kept, host.actors)
+						self.assertFalse(any(thread.is_alive() for thread in (removedActor.reader, removedActor.writer)))
+				finally:
+					host.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
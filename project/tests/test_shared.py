@@ -0,0 +1,46 @@
+import __init__
+import unittest
+
+from core.usb_util import MsgOperation, UnpackedMsg
+from core.usb_shared import SharedRing, putJob, getJob, putResults, getResults, putTimes, getTimes
+
+
+class USB_Shared_Test(unittest.TestCase):
+
+	def test_ring(self):
+		ring = SharedRing(64)
+		try:
+			# records wrap around the end of the ring
+			for i in range(20):
+				record = bytes([i]) * (i % 30)
+				ring.put(record[:3], record[3:])
+				self.assertEqual(ring.get(), record)
+			with self.assertRaises(ValueError):
+				ring.put(b"a" * 64)
+		finally:
+			ring.close(True)
+
+	def test_messages(self):
+		ring = SharedRing()
+		try:
+			putJob(ring, MsgOperation.TESTLOAD, "1000", 10000, [3, 2])
+			self.assertEqual(getJob(ring), (MsgOperation.TESTLOAD, "1000", 10000, [3, 2], False))
+			putJob(ring, MsgOperation.TESTLOAD, "10", 5, [], True)
+			self.assertEqual(getJob(ring), (MsgOperation.TESTLOAD, "10", 5, [], True))
+			putTimes(ring, [0.5, 0.25])
+			self.assertEqual(getTimes(ring), [0.5, 0.25])
+
+			results = [
+				UnpackedMsg(True, True, 1, 1, 2, 4, b"", 7, 1, 20, 1234, 1000, 0, False, 4096),
+				None,
+				UnpackedMsg(True, True, 1, 1, 2, 1, "1000"),
+				UnpackedMsg(True, True, -1, -1, -1, -1, ""),
+			]
+			putResults(ring, results)
+			self.assertEqual(getResults(ring), results)
+		finally:
+			ring.close(True)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,423 @@
+import __init__
+import asyncio
+import functools
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+from timeit import default_timer as timer
+from typing import Iterator
+
+from core.usb_util import CommunicationType, ProtocolType, TransportType, MsgAction, MsgOperation, MsgSender, MsgStatus, DeviceSelection
+from core.usb_util import Compression, Capabilities, Feature, MAX_FRAME_SIZE, STREAM_CHUNK_SIZE, packBinaryMsg, unpackBinaryMsg, packCapabilities
+import core.usb_host as usb_host
+import core.usb_client_protocol as usb_client_protocol
+from core.usb_host import CIRCUIT_FAILURES, INITIAL_TIMEOUT, MIN_TIMEOUT, MAX_TIMEOUT, RttEstimator, RetryPolicy, USB_Host, USB_Host_Threading, USB_Host_Asyncio, USB_Host_Multiprocessing, USB_Host_Hybrid, USB_Host_Actor
+from core.usb_transport import ReceiveBufferPool, Transport
+from core.usb_manager import MakeClients, ProcessTestLoad
+import eval.usb_testload as usb_testload
+
+HOSTS = {
+	CommunicationType.BASIC: USB_Host,
+	CommunicationType.THREADING: USB_Host_Threading,
+	CommunicationType.ASYNCIO: USB_Host_Asyncio,
+	CommunicationType.MULTIPROCESSING: USB_Host_Multiprocessing,
+	CommunicationType.HYBRID: USB_Host_Hybrid,
+	CommunicationType.ACTOR: USB_Host_Actor,
+}
+
+DEVICE_COUNT = 3
+
+
+class USB_Transport_Test(unittest.TestCase):
+	"""Runs every host strategy against local clients, so no gadgets are needed."""
+
+	@contextmanager
+	def startHost(
+		self,
+		comType: CommunicationType,
+		protocol: ProtocolType = ProtocolType.BINARY,
+		transportType: TransportType = TransportType.SOCKET,
+		clientCount: int = DEVICE_COUNT,
+		**kwargs) -> Iterator[USB_Host]:
+		"""Yields a host whose first clientCount devices have a running client, the others never answer."""
+		host = HOSTS[comType](DEVICE_COUNT, protocol, transportType=transportType, **kwargs)
+		for client in MakeClients(clientCount, protocol, host.echo, host.getClientFiles()):
+			client.daemon = True
+			client.activate()
+		try:
+			yield host
+		finally:
+			host.close()
+
+	def runHost(self, comType: CommunicationType, protocol: ProtocolType, transportType: TransportType, **kwargs):
+		with self.startHost(comType, protocol, transportType, **kwargs) as host:
+			host.prepareDevices()
+			load = usb_testload.TestLoad(10, 1000)
+			ProcessTestLoad(host, load, 2 * DEVICE_COUNT)
+			self.assertEqual(load.successCount, 2 * DEVICE_COUNT)
+			self.assertEqual(load.tryCount, 2 * DEVICE_COUNT)
+			self.assertEqual(len(load.getAllLoadTimes()), 2 * DEVICE_COUNT)
+			host.deactivate()
+
+	def test_pty(self):
+		for comType in HOSTS:
+			for protocol in ProtocolType:
+				with self.subTest(comType=comType, protocol=protocol):
+					self.runHost(comType, protocol, TransportType.PTY)
+
+	def test_pty_echo(self):
+		# text clients echo every command back and read lines from the canonical tty
+		for comType in HOSTS:
+			with self.subTest(comType=comType):
+				self.runHost(comType, ProtocolType.TEXT, TransportType.PTY, echo=True)
+
+	def test_socket(self):
+		for comType in HOSTS:
+			for protocol in ProtocolType:
+				with self.subTest(comType=comType, protocol=protocol):
+					self.runHost(comType, protocol, TransportType.SOCKET)
+
+	def test_batches(self):
+		for comType in HOSTS:
+			with self.subTest(comType=comType):
+				self.runHost(comType, ProtocolType.BINARY, TransportType.SOCKET, batchSize=4)
+
+	def test_hybrid_shards(self):
+		# two processes share three devices, loads that don't reach every device still work
+		for actionCount in (1, 2 * DEVICE_COUNT):
+			with self.subTest(actionCount=actionCount), self.startHost(CommunicationType.HYBRID, processCount=2) as host:
+				host.prepareDevices()
+				self.assertEqual(host.workerCount, 2)
+				load = usb_testload.TestLoad(10, 1000)
+				ProcessTestLoad(host, load, actionCount)
+				self.assertEqual(load.successCount, actionCount)
+				host.deactivate()
+
+	def test_stream(self):
+		# a test load streamed back in several chunks, once with blocking and once with awaited reads
+		dataLen = 2 * STREAM_CHUNK_SIZE + 100
+		with self.startHost(CommunicationType.ASYNCIO) as host:
+			devices = host.getDevices(-1)
+			chunks = list(host.streamMessage(devices[0], MsgAction.CALCULATE, MsgOperation.TESTLOAD, str(dataLen)))
+			self.assertEqual(len(chunks), 3)
+			self.assertEqual(sum(len(chunk) for chunk in chunks), dataLen)
+
+			async def streamAll():
+				return [chunk async for chunk in host.streamMessageAsync(devices[1], MsgAction.CALCULATE, MsgOperation.TESTLOAD, str(dataLen))]
+
+			chunks = asyncio.run(streamAll())
+			self.assertEqual(len(chunks), 3)
+			self.assertEqual(sum(len(chunk) for chunk in chunks), dataLen)
+			host.deactivate()
+
+	def test_multiply(self):
+		with self.startHost(CommunicationType.BASIC) as host:
+			self.assertTrue(host.ping())
+			answers = host.requestClientAction(MsgOperation.MULTIPLY, data="500")
+			self.assertEqual([bytes(answer.data) for answer in answers], [b"1000"] * DEVICE_COUNT)
+			host.deactivate()
+
+	def test_device_selection(self):
+		# a device that answers four times slower gets fewer loads, round robin ignores it
+		for selection in DeviceSelection:
+			with self.subTest(selection=selection):
+				host = USB_Host(DEVICE_COUNT, ProtocolType.BINARY, transportType=TransportType.SOCKET, deviceSelection=selection)
+				try:
+					devices = host.refreshDevices()
+					for device, rtt in zip(devices, (0.04, 0.01, 0.01)):
+						device.rtt = rtt
+					loads = host.getDeviceLoads(4 * DEVICE_COUNT)
+					self.assertEqual(sum(loads), 4 * DEVICE_COUNT)
+					if selection == DeviceSelection.ROUND_ROBIN:
+						self.assertEqual(loads, [4] * DEVICE_COUNT)
+					else:
+						self.assertLess(loads[0], 4)
+				finally:
+					host.close()
+
+	def test_default_selection(self):
+		# as many loads as idle devices give every device one of them
+		host = USB_Host(DEVICE_COUNT, ProtocolType.BINARY, transportType=TransportType.SOCKET)
+		try:
+			host.refreshDevices()
+			for _ in range(20):
+				self.assertEqual(host.getDeviceLoads(DEVICE_COUNT), [1] * DEVICE_COUNT)
+		finally:
+			host.close()
+
+	def test_capabilities(self):
+		# the client's receive window is the first credit limit, codecs it can't decompress are not used
+		host = USB_Host(DEVICE_COUNT, ProtocolType.BINARY, compression=Compression.ZLIB, transportType=TransportType.SOCKET)
+		try:
+			device = host.refreshDevices()[0]
+			capabilities = Capabilities(MAX_FRAME_SIZE, 64, 1000, 1, 4096, 0, Feature.LZMA.value)
+			answer = packBinaryMsg(MsgSender.CLIENT, MsgStatus.OK, MsgAction.HELLO, MsgOperation.NONE, packCapabilities(capabilities))
+			self.assertTrue(device.setCapabilities(unpackBinaryMsg(memoryview(answer))))
+			self.assertEqual(device.creditLimit, 1000)
+
+			data = "a" * 10000
+			pack = host.packMessage(MsgAction.CALCULATE, MsgOperation.TESTLOAD, data, 1, devices=[device])
+			self.assertEqual(unpackBinaryMsg(memoryview(pack)).compression, Compression.NONE.value)
+			pack = host.packMessage(MsgAction.CALCULATE, MsgOperation.TESTLOAD, data, 1, devices=host.devices[1:])
+			self.assertEqual(unpackBinaryMsg(memoryview(pack)).compression, Compression.ZLIB.value)
+		finally:
+			host.close()
+
+	def test_credit_wait(self):
+		# a client with room for two requests gets the third one only after an answer granted new credits
+		receiveWindow = usb_client_protocol.RECEIVE_WINDOW
+		requestCount = 6
+		try:
+			with self.startHost(CommunicationType.BASIC, clientCount=1) as host:
+				device = host.getDevices(0)[0]
+				packSize = len(host.packMessage(MsgAction.CALCULATE, MsgOperation.MULTIPLY, "500", 1, devices=[device]))
+				usb_client_protocol.RECEIVE_WINDOW = 2 * packSize + packSize // 2
+				host.getCapabilities(device)
+				self.assertEqual(device.getCredits(), usb_client_protocol.RECEIVE_WINDOW)
+
+				events = []
+				writeMessage, readMessage = host.writeMessage, host.readMessage
+
+				def recordWrite(dev, pack):
+					events.append(("write", len(pack) <= dev.getCredits()))
+					writeMessage(dev, pack)
+
+				def recordRead(dev, *args, **kwargs):
+					answer = readMessage(dev, *args, **kwargs)
+					events.append(("read", answer.credits))
+					return answer
+
+				host.writeMessage, host.readMessage = recordWrite, recordRead
+				answers = host.sendRequests(device, [(MsgAction.CALCULATE, MsgOperation.MULTIPLY, "500", 0)] * requestCount)
+				del host.writeMessage, host.readMessage
+				self.assertEqual([bytes(answer.data) for answer in answers], [b"1000"] * requestCount)
+
+				writes = [fits for event, fits in events if event == "write"]
+				self.assertEqual(len(writes), requestCount)
+				self.assertTrue(all(writes))
+				# the window, not maxInFlight, held back the third request
+				self.assertLess(2, host.maxInFlight)
+				self.assertEqual([event for event, _ in events[:3]], ["write", "write", "read"])
+				self.assertTrue(all(credits for event, credits in events if event == "read"))
+				host.deactivate()
+		finally:
+			usb_client_protocol.RECEIVE_WINDOW = receiveWindow
+
+	def test_rtt_estimator(self):
+		estimator = RttEstimator()
+		self.assertEqual(estimator.getTimeout(), INITIAL_TIMEOUT)
+		for _ in range(20):
+			estimator.update(0.01)
+		# a steady round trip time leaves almost no deviation
+		self.assertEqual(estimator.getTimeout(), MIN_TIMEOUT)
+		estimator.update(0.5)
+		self.assertGreater(estimator.getTimeout(), 500)
+		for _ in range(10):
+			estimator.timedOut()
+		self.assertEqual(estimator.getTimeout(), MAX_TIMEOUT)
+		estimator.update(0.01)
+		self.assertLess(estimator.getTimeout(), MAX_TIMEOUT)
+
+	def test_broadcast(self):
+		# the last device never answers, the others still do and every broadcast only waits for it once
+		with self.startHost(CommunicationType.BASIC, clientCount=DEVICE_COUNT - 1) as host:
+			answers = host.sendMessage(MsgAction.PING, MsgOperation.NONE)
+			self.assertEqual([answer is not None for answer in answers], [True] * (DEVICE_COUNT - 1) + [False])
+			self.assertFalse(host.ping())
+			self.assertEqual(host.takeTimeoutCount(), 2)
+			# the silent device backs off instead of timing out at the same rate
+			self.assertGreater(host.devices[-1].getTimeout(), INITIAL_TIMEOUT)
+			self.assertTrue(all(host.deactivate()[:DEVICE_COUNT - 1]))
+
+	def test_compute_pool(self):
+		# the calculations of the test loads run in a process pool, their times are collected separately
+		for comType in (CommunicationType.BASIC, CommunicationType.THREADING, CommunicationType.ASYNCIO):
+			with self.subTest(comType=comType), self.startHost(comType) as host:
+				host.useComputePool = True
+				host.prepareDevices()
+				load = usb_testload.TestLoad(1000, 100)
+				ProcessTestLoad(host, load, 2 * DEVICE_COUNT)
+				self.assertEqual(load.successCount, 2 * DEVICE_COUNT)
+				self.assertEqual(len(load.getAllComputeTimes()), 2 * DEVICE_COUNT)
+				self.assertFalse(host.computeFutures)
+				host.deactivate()
+
+	def test_async_compute(self):
+		# the event loop keeps reading while the host calculates, otherwise the other devices' reads would time out
+		calculateLoads = usb_host.calculateLoads
+		threads = []
+
+		def recordThread(count: int, loadCount: int):
+			threads.append(threading.get_ident())
+			return calculateLoads(count, loadCount)
+
+		usb_host.calculateLoads = recordThread
+		try:
+			with self.startHost(CommunicationType.ASYNCIO) as host:
+				host.useComputePool = False
+				host.prepareDevices()
+				load = usb_testload.TestLoad(1000, 100)
+				ProcessTestLoad(host, load, 2 * DEVICE_COUNT)
+				self.assertEqual(len(load.getAllComputeTimes()), 2 * DEVICE_COUNT)
+				self.assertTrue(threads)
+				self.assertNotIn(threading.get_ident(), threads)
+				host.deactivate()
+		finally:
+			usb_host.calculateLoads = calculateLoads
+
+	def test_async_transfer_threads(self):
+		# transports without asynchronous transfers wait on a pool of their own, with a thread for every device
+		with self.startHost(CommunicationType.ASYNCIO) as host:
+			threads = set()
+			for dev in host.getDevices(-1):
+				readInto = dev.transport.readInto
+
+				def recordThread(buffer, timeout=1000, readInto=readInto):
+					threads.add(threading.current_thread().name)
+					return readInto(buffer, timeout)
+
+				dev.transport.readInto = recordThread
+				dev.transport.hasAsyncTransfers = lambda: False
+				dev.transport.writeAsync = functools.partial(Transport.writeAsync, dev.transport)
+				dev.transport.receiveAsync = functools.partial(Transport.receiveAsync, dev.transport)
+			host.prepareDevices()
+			load = usb_testload.TestLoad(10, 1000)
+			ProcessTestLoad(host, load, 2 * DEVICE_COUNT)
+			self.assertEqual(load.successCount, 2 * DEVICE_COUNT)
+			self.assertEqual(host.getTransferExecutor()._max_workers, DEVICE_COUNT)
+			self.assertTrue(threads)
+			self.assertTrue(all(name.startswith("USB_Transfer") for name in threads))
+			host.deactivate()
+
+	def test_worker_compute_times(self):
+		# worker processes hand the times of their calculations back with every job
+		for comType in (CommunicationType.MULTIPROCESSING, CommunicationType.HYBRID):
+			with self.subTest(comType=comType), self.startHost(comType) as host:
+				host.prepareDevices()
+				load = usb_testload.TestLoad(1000, 100)
+				ProcessTestLoad(host, load, 2 * DEVICE_COUNT, repeats=2)
+				self.assertEqual(load.successCount, 4 * DEVICE_COUNT)
+				self.assertEqual(len(load.getAllComputeTimes()), 4 * DEVICE_COUNT)
+				self.assertGreater(load.getAvgComputeTime(), 0)
+				self.assertGreater(load.transfers, 0)
+				host.deactivate()
+
+	def test_worker_timeouts(self):
+		# reads that time out in a worker process are counted by the host
+		with self.startHost(CommunicationType.MULTIPROCESSING, clientCount=DEVICE_COUNT - 1, retryPolicy=RetryPolicy(0)) as host:
+			# the handshake would only time out as well, the workers inherit the devices
+			host.devices[-1].handshakeDone = True
+			host.prepareDevices()
+			# every device gets one request, so the wedged one is asked as well
+			answers = host.requestClientAction(MsgOperation.MULTIPLY, data="500")
+			self.assertEqual(len([answer for answer in answers if answer]), DEVICE_COUNT - 1)
+			self.assertGreater(host.takeTimeoutCount(), 0)
+			self.assertEqual(host.takeTimeoutCount(), 0)
+			host.deactivate()
+
+	def test_actor_stragglers(self):
+		# an answer nobody asked for is drained by the reader right away and doesn't confuse the next request
+		with self.startHost(CommunicationType.ACTOR) as host:
+			host.prepareDevices()
+			device = host.devices[0]
+			device.transport.write(host.packMessage(MsgAction.PING, MsgOperation.NONE, "", 999))
+			actor = host.getActor(device)
+			start = timer()
+			while not actor.unclaimed and timer() - start < 1:
+				time.sleep(0.01)
+			self.assertEqual([answer.requestId for answer in actor.unclaimed], [999])
+			answer = host.sendSingleMessage(device, MsgAction.PING, MsgOperation.NONE)
+			self.assertEqual(answer.requestId, device.requestId)
+			self.assertTrue(host.ping())
+			host.deactivate()
+
+	def test_receive_buffers(self):
+		pool = ReceiveBufferPool(64)
+		self.assertEqual(pool.getSize(1), 64)
+		self.assertEqual(pool.getSize(65), 128)
+		buffer = pool.get(100)
+		pool.put(buffer)
+		self.assertIs(pool.get(128), buffer)
+		self.assertEqual(pool.allocations, 1)
+
+		# large answers are read in whole packets into buffers that are allocated once
+		with self.startHost(CommunicationType.BASIC) as host:
+			host.prepareDevices()
+			for repeat in range(2):
+				load = usb_testload.TestLoad(10, 100000)
+				ProcessTestLoad(host, load, DEVICE_COUNT)
+				self.assertEqual(load.successCount, DEVICE_COUNT)
+				self.assertGreater(load.transfers, 0)
+				if repeat:
+					self.assertEqual(load.allocations, 0)
+			host.deactivate()
+
+	def test_circuit_breaker(self):
+		# the last client is wedged, after its first loads failed it is out of rotation and the others take over
+		with self.startHost(CommunicationType.THREADING, clientCount=DEVICE_COUNT - 1, retryPolicy=RetryPolicy(1)) as host:
+			host.prepareDevices()
+			wedged = host.devices[-1]
+			# the handshake would only time out as well
+			wedged.handshakeDone = True
+			load = usb_testload.TestLoad(10, 1000)
+			ProcessTestLoad(host, load, 4 * DEVICE_COUNT)
+			self.assertTrue(wedged.breaker.isOpen())
+			self.assertEqual(load.tryCount, 4 * DEVICE_COUNT)
+
+			load = usb_testload.TestLoad(10, 1000)
+			ProcessTestLoad(host, load, 4 * DEVICE_COUNT)
+			self.assertEqual(load.successCount, 4 * DEVICE_COUNT)
+			# no load waited for the wedged device, at most a probe did if the run was slow
+			self.assertLessEqual(load.timeouts, 1)
+			self.assertEqual(host.getDeviceLoads(DEVICE_COUNT)[-1], 0)
+
+	def test_all_circuits_open(self):
+		# no device takes any load, every repeat still counts all of them as failed
+		with self.startHost(CommunicationType.BASIC, clientCount=0, retryPolicy=RetryPolicy(0)) as host:
+			host.prepareDevices()
+			for device in host.devices:
+				device.handshakeDone = True
+				for _ in range(CIRCUIT_FAILURES):
+					device.breaker.recordFailure()
+			load = usb_testload.TestLoad(10, 1000)
+			ProcessTestLoad(host, load, 4 * DEVICE_COUNT, repeats=3)
+			self.assertEqual(load.tryCount, 12 * DEVICE_COUNT)
+			self.assertEqual(load.successCount, 0)
+			self.assertEqual(len(load.times), 3)
+
+	def test_load_times(self):
+		# a load takes from the start of its own request to its answer, the slow handshake before it doesn't count
+		delay = 0.4
+		for comType in (CommunicationType.BASIC, CommunicationType.ASYNCIO):
+			with self.subTest(comType=comType), self.startHost(comType) as host:
+				handshake = host.handshake
+
+				def slowHandshake(device):
+					time.sleep(delay)
+					return handshake(device)
+
+				host.handshake = slowHandshake
+				if isinstance(host, USB_Host_Asyncio):
+					handshakeAsync = host.handshakeAsync
+
+					async def slowHandshakeAsync(device):
+						await asyncio.sleep(delay)
+						return await handshakeAsync(device)
+
+					host.handshakeAsync = slowHandshakeAsync
+				host.prepareDevices()
+				load = usb_testload.TestLoad(10, 100)
+				ProcessTestLoad(host, load, 2 * DEVICE_COUNT)
+				self.assertEqual(len(load.getAllLoadTimes()), 2 * DEVICE_COUNT)
+				self.assertLess(max(load.getAllLoadTimes()), delay / host.getQueueChunk())
+				host.deactivate()
+
+	def test_retry_policy(self):
+		policy = RetryPolicy(3, 0.01, 0.03)
+		for attempt in range(5):
+			self.assertTrue(0 <= policy.getDelay(attempt) <= min(0.03, 0.01 * 2 ** attempt))
+
+
+if __name__ == '__main__':
+	unittest.main()